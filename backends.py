@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import shutil
+import subprocess
+import threading
+
+from cancel import CancelToken
+import pipeline
+import profiles
+from runlog import NullRunLog
+
+# Backends run the programs that turn a FLAC file into the files of one or more output profiles:
+#     pipe      flac decodes, the audio is piped into lame (or ffmpeg for AAC), one encoder process per profile
+#     ffmpeg    a single ffmpeg process decodes the FLAC file and writes all profiles itself, including the tags; saves
+#               starting a second process and copying the audio through a pipe, which is noticeable on short tracks
+#     remote    the encode workers of remote.py on other machines, see there; only used when a profile names it
+# A profile names its backend, or leaves the choice to a BackendSelector, which times the first files of a run.
+
+
+class PipeBackend(object):
+    name = 'pipe'
+    automatic = True
+
+    def is_available(self):
+        return shutil.which(pipeline.flac_binary) is not None
+
+    def supports(self, profile):
+        binary = profiles.lame_binary if profile.encoder == 'lame' else profiles.ffmpeg_binary
+        return shutil.which(binary) is not None
+
+    def transcode(self, input_file_path, outputs, tags, cancel_token=None, run_log=None, committed=None,
+                  replaceable=()):
+        pipeline.transcode(input_file_path, outputs, tags, cancel_token=cancel_token, run_log=run_log,
+                           committed=committed, replaceable=replaceable)
+
+
+class FfmpegBackend(object):
+    name = 'ffmpeg'
+    automatic = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.encoders = None
+
+    def available_encoders(self):
+        """ Names of the audio encoders the installed ffmpeg was built with, asked once. """
+        with self.lock:
+            if self.encoders is None:
+                self.encoders = set()
+                try:
+                    output = subprocess.check_output([profiles.ffmpeg_binary, '-hide_banner', '-encoders'],
+                                                     stderr=subprocess.DEVNULL).decode('utf-8', 'replace')
+                except (OSError, subprocess.CalledProcessError):
+                    output = ''
+                for line in output.splitlines():
+                    fields = line.split()
+                    if len(fields) >= 2 and fields[0].startswith('A'):
+                        self.encoders.add(fields[1])
+            return self.encoders
+
+    def is_available(self):
+        return bool(self.available_encoders())
+
+    def supports(self, profile):
+        try:
+            profile.ffmpeg_codec_options()
+        except ValueError:
+            return False
+        return ('libmp3lame' if profile.encoder == 'lame' else 'aac') in self.available_encoders()
+
+    def transcode(self, input_file_path, outputs, tags, cancel_token=None, run_log=None, committed=None,
+                  replaceable=()):
+        """ Decode input_file_path and write all outputs in one ffmpeg process, like pipeline.transcode(). """
+        if cancel_token is None:
+            cancel_token = CancelToken()
+        if run_log is None:
+            run_log = NullRunLog()
+        cancel_token.raise_if_cancelled()
+
+        def run(staging_paths, start):
+            command = [profiles.ffmpeg_binary, '-nostdin', '-loglevel', 'error', '-i', input_file_path]
+            for (profile, _, _), staging_path in zip(outputs, staging_paths):
+                command += profile.ffmpeg_output_options(tags, staging_path)
+
+            process = subprocess.Popen(pipeline.with_priority(command), stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+            cancel_token.register(process)
+            try:
+                _, error_output = process.communicate()
+            finally:
+                cancel_token.unregister(process)
+            cancel_token.raise_if_cancelled()
+
+            if process.returncode != 0:
+                return [subprocess.CalledProcessError(process.returncode, command, stderr=error_output)] * len(outputs)
+            return [None] * len(outputs)
+
+        pipeline.write_outputs(input_file_path, outputs, run, cancel_token, run_log, committed, replaceable)
+
+
+backends = {backend.name: backend for backend in (PipeBackend(), FfmpegBackend())}
+
+
+class BackendSelector(object):
+    """ Picks the backend for the profiles that leave the choice open, by timing the first files of a run.
+
+    The first files are handed out to all backends that can run the profiles in turn, until each of them transcoded
+    calibration_files files. From then on the one that needed the least time per second of audio is used. With only one
+    backend that can run the profiles there is nothing to calibrate.
+
+    listener(message) is called once the choice is made.
+    """
+
+    calibration_files = 3
+
+    def __init__(self, candidates, listener=None, run_log=None):
+        self.candidates = candidates
+        self.listener = listener
+        self.run_log = run_log if run_log is not None else NullRunLog()
+        self.lock = threading.Lock()
+        # Per backend name: [files, seconds, seconds of audio]
+        self.timings = {backend.name: [0, 0.0, 0.0] for backend in candidates}
+        self.handed_out = {backend.name: 0 for backend in candidates}
+        self.chosen = candidates[0] if len(candidates) == 1 else None
+
+    def choose(self):
+        with self.lock:
+            if self.chosen is not None:
+                return self.chosen
+            # The backend with the fewest files so far, files that are still running count too.
+            backend = min(self.candidates, key=lambda candidate: self.handed_out[candidate.name])
+            if self.handed_out[backend.name] >= self.calibration_files:
+                # Everything is handed out, wait for the timings by using the first backend in the meantime.
+                return self.candidates[0]
+            self.handed_out[backend.name] += 1
+            return backend
+
+    def record(self, backend, seconds, audio_seconds):
+        with self.lock:
+            if self.chosen is not None or backend.name not in self.timings:
+                return
+            timing = self.timings[backend.name]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] += audio_seconds
+            if any(files < self.calibration_files for files, _, _ in self.timings.values()):
+                return
+
+            speeds = {name: audio / seconds if seconds > 0 else 0.0 for name, (_, seconds, audio) in
+                      self.timings.items()}
+            self.chosen = next(candidate for candidate in self.candidates
+                               if candidate.name == max(speeds, key=speeds.get))
+
+        self.run_log.write({'event': 'backend', 'backend': self.chosen.name, 'speeds': speeds})
+        if self.listener is not None:
+            self.listener('Encoder backend %s (%s)' % (self.chosen.name, ', '.join(
+                '%s %.1fx' % (name, speed) for name, speed in sorted(speeds.items()))))
+
+
+def candidates_for(profile_list):
+    """ The available backends the BackendSelector may pick for profile_list, the pipe backend first. """
+    return [backend for backend in backends.values()
+            if backend.automatic and backend.is_available()
+            and all(backend.supports(profile) for profile in profile_list)]
@@ -0,0 +1,364 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import array
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import backends
+import flacmeta
+import pipeline
+from runlog import RunLog
+import scanner
+from scheduler import TranscodeScheduler
+import transcode
+
+# Measures the throughput of transcode.py on a synthetic corpus.
+#
+# The corpus is generated locally and deterministically (same arguments, same files): PCM audio written as WAV and
+# encoded with the flac command line tool, tagged like real rips, some albums split into CD1/CD2 folders, a folder.jpg
+# per album and a few mp3/m4a files that are only copied. Each worker count is measured in a fresh child process, so
+# CPU time and peak memory belong to exactly one run. The result is written as JSON to compare revisions against each
+# other, e.g.
+#     python3 benchmark.py --workers 1 2 4 8 --output before.json
+# With --backend remote the worker counts are numbers of encode workers (remote.py, one slot each) started on this
+# machine, which shows how the throughput scales with added workers.
+
+corpus_version = 1
+
+sample_rate = 44100
+channels = 2
+
+genres = ['Rock', 'Jazz', 'Hip-Hop', 'Electronic', 'Folk', 'Classical']
+words = ['night', 'river', 'golden', 'i', 'city', 'glass', 'echo', 'summer', 'lost', 'paper', 'machine', 'blue']
+
+
+def track_durations(rng, tracks, mean_duration):
+    # Real albums mix short interludes with long tracks, which matters for longest first scheduling.
+    return [max(5, int(mean_duration * rng.choice([0.25, 0.5, 0.75, 1.0, 1.0, 1.5, 2.5]))) for _ in range(tracks)]
+
+
+def title(rng, word_count):
+    # Lower case and with brackets on purpose, so better_capitalize() has something to do.
+    text = ' '.join(rng.choice(words) for _ in range(word_count))
+    if rng.random() < 0.2:
+        text += ' (%s mix)' % rng.choice(words)
+    return text
+
+
+def write_wav(wav_path, rng, duration):
+    # One second of a chord plus noise, repeated. FLAC compresses every frame on its own, so the repetition doesn't
+    # make the file unrealistically small.
+    frequencies = [rng.uniform(110, 880) for _ in range(3)]
+    second = array.array('h')
+    for n in range(sample_rate):
+        value = sum(math.sin(2 * math.pi * f * n / sample_rate) for f in frequencies) / len(frequencies)
+        for _ in range(channels):
+            second.append(int(value * 12000 + rng.gauss(0, 600)))
+    if sys.byteorder == 'big':
+        second.byteswap()
+
+    with wave.open(wav_path, 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        second_bytes = second.tobytes()
+        for _ in range(duration):
+            w.writeframes(second_bytes)
+
+
+def write_random_file(path, rng, size, header=b'', footer=b''):
+    block = bytes(rng.getrandbits(8) for _ in range(4096))
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write((block * (size // len(block) + 1))[:size])
+        f.write(footer)
+
+
+def generate_corpus(corpus_dir, albums, tracks, mean_duration, seed):
+    """ Create the corpus in corpus_dir, unless a corpus with the same parameters already exists there. """
+    manifest = {'version': corpus_version, 'albums': albums, 'tracks': tracks, 'mean_duration': mean_duration,
+                'seed': seed}
+    manifest_path = os.path.join(corpus_dir, 'corpus.json')
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            if json.load(f) == manifest:
+                return
+        shutil.rmtree(corpus_dir)
+
+    if shutil.which(pipeline.flac_binary) is None:
+        sys.exit('Generating the corpus needs the flac command line tool at %s' % pipeline.flac_binary)
+
+    rng = random.Random(seed)
+    os.makedirs(corpus_dir)
+
+    for album_number in range(albums):
+        artist = title(rng, 2)
+        album_dir = os.path.join(corpus_dir, artist, '[%i] %s' % (1970 + album_number, title(rng, 3)))
+
+        # Every second album is a two disc set.
+        discs = 2 if album_number % 2 else 1
+        for disc in range(1, discs + 1):
+            disc_dir = os.path.join(album_dir, 'CD%i' % disc) if discs > 1 else album_dir
+            os.makedirs(disc_dir)
+
+            for track, duration in enumerate(track_durations(rng, tracks, mean_duration), 1):
+                track_title = title(rng, rng.randint(1, 4))
+                flac_path = os.path.join(disc_dir, '%02i - %s.flac' % (track, track_title))
+                wav_path = flac_path[:-5] + '.wav'
+                write_wav(wav_path, rng, duration)
+                tags = {'ARTIST': artist, 'TITLE': track_title, 'TRACKNUMBER': str(track),
+                        'ALBUM': os.path.basename(album_dir), 'DATE': str(1970 + album_number),
+                        'GENRE': rng.choice(genres), 'DISCNUMBER': str(disc)}
+                command = [pipeline.flac_binary, '--silent', '--force', '-o', flac_path]
+                command += ['--tag=%s=%s' % (name, value) for name, value in sorted(tags.items())]
+                subprocess.check_call(command + [wav_path])
+                os.remove(wav_path)
+
+            # Bonus tracks that are only copied.
+            write_random_file(os.path.join(disc_dir, 'bonus %i.mp3' % disc), rng, 4 * 1024 * 1024, header=b'ID3')
+            if album_number % 3 == 2:
+                write_random_file(os.path.join(disc_dir, 'bonus %i.m4a' % disc), rng, 3 * 1024 * 1024)
+
+        # Only the header and footer markers are those of a real JPEG, it is copied but never decoded.
+        write_random_file(os.path.join(album_dir, 'folder.jpg'), rng, 200 * 1024, header=b'\xff\xd8\xff\xe0',
+                          footer=b'\xff\xd9')
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def corpus_albums(corpus_dir):
+    return sorted(os.path.join(artist.path, album.name)
+                  for artist in os.scandir(corpus_dir) if artist.is_dir()
+                  for album in os.scandir(artist.path) if album.is_dir())
+
+
+def rusage_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def max_rss_bytes(usage):
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def measure_run(corpus_dir, workers, backend=None):
+    """ Transcode the whole corpus once with the given number of workers and backend. Runs inside the child process. """
+    output_dir = tempfile.mkdtemp(prefix='transcode_benchmark_')
+    try:
+        # Point the settings of transcode.py at throwaway directories, a fresh index makes sure nothing is skipped.
+        transcode.itunes_import_dir = os.path.join(output_dir, 'import')
+        transcode.cover_art_output_dir = os.path.join(output_dir, 'covers')
+        transcode.index_path = os.path.join(output_dir, 'index.sqlite3')
+        transcode.run_log_path = os.path.join(output_dir, 'run.jsonl')
+        os.makedirs(transcode.itunes_import_dir)
+
+        stages = {}
+
+        start = time.perf_counter()
+        flac_paths = [item.path for item in scanner.scan(corpus_dir) if item.action == scanner.ACTION_TRANSCODE]
+        stages['scan'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        audio_seconds = sum(flacmeta.read_metadata(flac_path).duration for flac_path in flac_paths)
+        stages['metadata'] = time.perf_counter() - start
+
+        albums = corpus_albums(corpus_dir)
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        # All albums at once, like several folders dropped in a row. 0 workers measures the adaptive concurrency.
+        scheduler = TranscodeScheduler(transcode.itunes_import_dir, transcode.cover_art_output_dir,
+                                       transcode.lame_options, transcode.index_path, workers,
+                                       RunLog(transcode.run_log_path), backend=backend)
+        for album in [scheduler.submit(album_dir) for album_dir in albums]:
+            album.wait()
+        final_workers = scheduler.workers
+        scheduler.shutdown()
+        wall = time.perf_counter() - start
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stages['transcode'] = wall
+
+        # Time spent per stage of the files, summed over all workers (so it can exceed the wall time).
+        file_stages = {}
+        with open(transcode.run_log_path, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['event'] == 'stage':
+                    file_stages[record['stage']] = file_stages.get(record['stage'], 0.0) + record['seconds']
+
+        cpu_seconds = (rusage_seconds(self_after) - rusage_seconds(self_before) +
+                       rusage_seconds(children_after) - rusage_seconds(children_before))
+
+        return {
+            'workers': workers,
+            'backend': backend,
+            'final_workers': final_workers,
+            'wall_seconds': wall,
+            'stage_seconds': stages,
+            'file_stage_seconds': file_stages,
+            'tracks': len(flac_paths),
+            'tracks_per_second': len(flac_paths) / wall,
+            'audio_seconds': audio_seconds,
+            'audio_seconds_per_second': audio_seconds / wall,
+            'cpu_seconds': cpu_seconds,
+            'cpu_utilisation': cpu_seconds / (wall * (os.cpu_count() or 1)),
+            'peak_rss_bytes': max_rss_bytes(self_after),
+            'peak_child_rss_bytes': max_rss_bytes(children_after),
+        }
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def start_encode_workers(count):
+    """ Start count encode workers with one slot each on free localhost ports, return the processes and addresses. """
+    processes = []
+    addresses = []
+    remote_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remote.py')
+    for _ in range(count):
+        process = subprocess.Popen([sys.executable, remote_path, '--listen', '127.0.0.1:0', '--slots', '1'],
+                                   stdout=subprocess.PIPE)
+        processes.append(process)
+        # 'Listening on host:port with ...'
+        addresses.append(process.stdout.readline().decode('utf-8').split()[2])
+    return processes, addresses
+
+
+def run_in_child(corpus_dir, workers, backend):
+    command = [sys.executable, os.path.abspath(__file__), '--corpus', corpus_dir, '--single-run', str(workers)]
+    if backend is not None:
+        command += ['--backend', backend]
+
+    encode_workers = []
+    try:
+        if backend == 'remote':
+            encode_workers, addresses = start_encode_workers(workers)
+            command += ['--remote-workers', ','.join(addresses)]
+        output = subprocess.check_output(command)
+    finally:
+        for process in encode_workers:
+            process.terminate()
+            process.wait()
+    return json.loads(output.decode('utf-8'))
+
+
+def measure_cold_start(repeat):
+    """ Wall time of the headless command line from start to exit (planning an empty folder), and whether it loaded Qt.
+
+    This is the fixed cost every scripted run pays before the first file is read.
+    """
+    empty_dir = tempfile.mkdtemp(prefix='transcode_cold_start_')
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    command = [main_path, '--headless', '--dry-run', empty_dir]
+    try:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable] + command, stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+
+        # -X importtime lists every module that was imported (and slows the start down, so it isn't timed).
+        import_times = subprocess.run([sys.executable, '-X', 'importtime'] + command, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.PIPE, check=True).stderr.decode('utf-8', 'replace')
+    finally:
+        shutil.rmtree(empty_dir, ignore_errors=True)
+
+    times.sort()
+    return {
+        'min_seconds': times[0],
+        'median_seconds': times[len(times) // 2],
+        'imported_modules': len(import_times.splitlines()) - 1,
+        'qt_loaded': 'PyQt5' in import_times,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def process_cl_args():
+    parser = argparse.ArgumentParser(description='Measure the transcoding throughput on a synthetic corpus.')
+    parser.add_argument('--corpus', default=os.path.join(tempfile.gettempdir(), 'transcode_benchmark_corpus'),
+                        help='directory of the generated corpus, reused if it was generated with the same arguments')
+    parser.add_argument('--albums', type=int, default=4)
+    parser.add_argument('--tracks', type=int, default=8, help='tracks per disc')
+    parser.add_argument('--duration', type=int, default=60, help='mean track length in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, os.cpu_count() or 1],
+                        help='worker counts to measure, 0 lets the concurrency controller adjust the count')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per worker count')
+    parser.add_argument('--backend', nargs='+', choices=['auto', 'pipe', 'ffmpeg', 'remote'], default=['auto'],
+                        help='encoder backends to measure, auto times both on the first files and keeps the faster, '
+                             'remote starts as many local encode workers as --workers')
+    parser.add_argument('--cold-starts', type=int, default=5, help='headless starts to time, 0 to skip')
+    parser.add_argument('--output', help='write the JSON result to this file instead of stdout')
+    parser.add_argument('--single-run', type=int, help=argparse.SUPPRESS)  # used for the child processes
+    parser.add_argument('--remote-workers', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_cl_args()
+
+    if args.single_run is not None:
+        backend = args.backend[0] if args.backend != ['auto'] else None
+        workers = args.single_run
+        if backend == 'remote':
+            # The remote pool gets as many workers as the encode workers have slots.
+            backends.backends['remote'].configure(args.remote_workers.split(','))
+            result = measure_run(args.corpus, 0, backend)
+            result['workers'] = workers
+            print(json.dumps(result))
+            sys.exit(0)
+        print(json.dumps(measure_run(args.corpus, workers, backend)))
+        sys.exit(0)
+
+    generate_corpus(args.corpus, args.albums, args.tracks, args.duration, args.seed)
+
+    runs = []
+    for backend in args.backend:
+        for workers in args.workers:
+            for _ in range(args.repeat):
+                runs.append(run_in_child(args.corpus, workers, backend if backend != 'auto' else None))
+                print('%s, %i workers: %.2f s, %.1f audio-s/s' %
+                      (backend, workers, runs[-1]['wall_seconds'], runs[-1]['audio_seconds_per_second']),
+                      file=sys.stderr)
+
+    cold_start = None
+    if args.cold_starts > 0:
+        cold_start = measure_cold_start(args.cold_starts)
+        print('Cold start: %.3f s, Qt %s' % (cold_start['min_seconds'],
+                                             'loaded' if cold_start['qt_loaded'] else 'not loaded'), file=sys.stderr)
+
+    result = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'corpus': {'albums': args.albums, 'tracks': args.tracks, 'mean_duration': args.duration, 'seed': args.seed},
+        'cold_start': cold_start,
+        'runs': runs,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import signal
+import threading
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken(object):
+    """ Cancels a run, including the flac/lame processes that are running at that moment.
+
+    Every child process is started in its own process group (start_new_session=True) and registered here while it runs.
+    cancel() sends SIGTERM to all registered process groups right away and SIGKILL to the ones still alive after
+    kill_timeout seconds, so cancelling never waits for a running encode to finish. The transcode functions notice the
+    dead processes, remove their partial output and raise Cancelled.
+
+    cancel() may be called from any thread (e.g. the GUI thread), callbacks registered with on_cancel() are run from it.
+    """
+
+    kill_timeout = 0.5
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise Cancelled()
+
+    def on_cancel(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def register(self, process):
+        with self.lock:
+            if not self.event.is_set():
+                self.processes.add(process)
+                return
+        # Started while cancel() was running, stop it right away.
+        self.kill(process, signal.SIGKILL)
+
+    def unregister(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def cancel(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            processes = list(self.processes)
+            callbacks = list(self.callbacks)
+
+        for process in processes:
+            self.kill(process, signal.SIGTERM)
+
+        if processes:
+            timer = threading.Timer(self.kill_timeout, self.kill_remaining, args=(processes,))
+            timer.daemon = True
+            timer.start()
+
+        for callback in callbacks:
+            callback()
+
+    def kill_remaining(self, processes):
+        for process in processes:
+            self.kill(process, signal.SIGKILL)
+
+    @staticmethod
+    def kill(process, signal_number):
+        if process.poll() is not None:  # already exited, its process group id may be reused by now
+            return
+        try:
+            os.killpg(process.pid, signal_number)
+        except (ProcessLookupError, PermissionError):
+            pass  # already gone (and maybe reaped)
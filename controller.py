@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import os
+import threading
+import time
+
+from runlog import NullRunLog
+
+# Adjusts the number of concurrent flac/lame pipelines while transcoding.
+#
+# Tracks read from a NAS spend much of their time waiting for data, more pipelines than cores keep the cores busy.
+# Tracks on a local SSD are limited by lame, more pipelines than cores only add context switches. Which one applies
+# isn't known in advance, so the controller measures it every few seconds:
+#     throughput    seconds of audio transcoded per second
+#     cpu idle      share of the CPU time nobody used, from /proc/stat
+#     read stalls   share of the time tasks waited for I/O, from /proc/pressure/io (or iowait of /proc/stat)
+# and adds a pipeline while cores are idle and tracks are waiting, removes one while the CPU is saturated with more
+# pipelines than cores, and undoes a change that made the throughput worse.
+
+Sample = namedtuple('Sample', ['throughput', 'cpu_idle', 'io_stall'])
+
+proc_stat_path = '/proc/stat'
+proc_pressure_io_path = '/proc/pressure/io'
+
+
+def read_cpu_times():
+    """ Return (total, idle, iowait) jiffies of all CPUs since boot, None where /proc/stat doesn't exist. """
+    try:
+        with open(proc_stat_path, 'r') as f:
+            fields = f.readline().split()
+    except OSError:
+        return None
+    if not fields or fields[0] != 'cpu':
+        return None
+    # user nice system idle iowait irq softirq steal (guest time is already included in user/nice)
+    values = [int(value) for value in fields[1:9]]
+    return sum(values), values[3], values[4]
+
+
+def read_io_stall_us():
+    """ Microseconds some task waited for I/O since boot (pressure stall information, Linux 4.20+), or None. """
+    try:
+        with open(proc_pressure_io_path, 'r') as f:
+            for line in f:
+                if line.startswith('some '):
+                    for field in line.split():
+                        if field.startswith('total='):
+                            return int(field[len('total='):])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def is_supported():
+    return read_cpu_times() is not None
+
+
+class ConcurrencyController(object):
+    """ Resizes a TranscodePool at runtime, see the comment at the top of the module.
+
+    audio_seconds_done is a callable returning the seconds of audio transcoded so far, pending_jobs one returning the
+    number of tracks waiting for a worker. listener(message) is called (from the controller thread) for every change.
+    """
+
+    interval = 5.0
+
+    # Share of idle CPU above which there is room for another pipeline, and below which the CPU counts as saturated.
+    idle_high = 0.15
+    idle_low = 0.05
+
+    # A change that lowers the throughput by more than this is undone. Tracks finish in bursts, so small differences
+    # are noise.
+    tolerance = 0.10
+
+    # Samples to wait after a change before judging it, the first one still mixes the old and new concurrency.
+    settle_samples = 2
+
+    def __init__(self, pool, audio_seconds_done, pending_jobs, min_workers=1, max_workers=None, listener=None,
+                 run_log=None):
+        self.pool = pool
+        self.audio_seconds_done = audio_seconds_done
+        self.pending_jobs = pending_jobs
+        self.cpu_count = os.cpu_count() or 1
+        self.min_workers = min_workers
+        self.max_workers = max_workers if max_workers else 4 * self.cpu_count
+        self.listener = listener
+        self.run_log = run_log if run_log is not None else NullRunLog()
+
+        # The change that is being judged: (workers before, throughput before), None if there is none.
+        self.last_change = None
+        self.samples_since_change = 0
+        # Increasing again right after an undone increase would only repeat the same experiment.
+        self.blocked_until = 0.0
+
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        previous_time = time.monotonic()
+        previous_done = self.audio_seconds_done()
+        previous_cpu = read_cpu_times()
+        previous_stall = read_io_stall_us()
+
+        while not self.stopping.wait(self.interval):
+            now = time.monotonic()
+            done = self.audio_seconds_done()
+            cpu = read_cpu_times()
+            stall = read_io_stall_us()
+
+            elapsed = now - previous_time
+            throughput = (done - previous_done) / elapsed if elapsed > 0 else 0.0
+
+            cpu_idle = 0.0
+            io_stall = 0.0
+            if cpu is not None and previous_cpu is not None and cpu[0] > previous_cpu[0]:
+                cpu_idle = (cpu[1] - previous_cpu[1]) / (cpu[0] - previous_cpu[0])
+                io_stall = (cpu[2] - previous_cpu[2]) / (cpu[0] - previous_cpu[0])
+            if stall is not None and previous_stall is not None and elapsed > 0:
+                io_stall = min((stall - previous_stall) / (elapsed * 1000000), 1.0)
+
+            sample = Sample(throughput, cpu_idle, io_stall)
+            self.apply(self.decide(sample, self.pending_jobs(), now), sample)
+
+            previous_time, previous_done, previous_cpu, previous_stall = now, done, cpu, stall
+
+    def decide(self, sample, pending_jobs, now):
+        """ Return (new number of workers, reason, whether to judge the change later).
+
+        The number of workers is unchanged if nothing needs to change.
+        """
+        workers = self.pool.workers
+        self.samples_since_change += 1
+
+        if self.last_change is not None:
+            if self.samples_since_change < self.settle_samples:
+                return workers, None, False
+            workers_before, throughput_before = self.last_change
+            self.last_change = None
+            # Without waiting tracks the throughput drops anyway, as the last tracks of the queue finish.
+            if pending_jobs > 0 and sample.throughput < throughput_before * (1 - self.tolerance):
+                if workers > workers_before:
+                    self.blocked_until = now + 6 * self.interval
+                return (workers_before, 'throughput fell from %.1fx to %.1fx' % (throughput_before, sample.throughput),
+                        False)
+
+        status = 'CPU %i%% idle, reads stalled %i%%, %.1fx' % (sample.cpu_idle * 100, sample.io_stall * 100,
+                                                                sample.throughput)
+        if sample.cpu_idle > self.idle_high and pending_jobs > 0 and workers < self.max_workers \
+                and now >= self.blocked_until:
+            return workers + 1, status, True
+        if sample.cpu_idle < self.idle_low and workers > max(self.cpu_count, self.min_workers):
+            return workers - 1, status, True
+        return workers, None, False
+
+    def apply(self, decision, sample):
+        workers, reason, judge_later = decision
+        previous_workers = self.pool.workers
+        workers = min(max(workers, self.min_workers), self.max_workers)
+        if workers == previous_workers:
+            return
+
+        self.pool.resize(workers)
+        self.last_change = (previous_workers, sample.throughput) if judge_later else None
+        self.samples_since_change = 0
+
+        self.run_log.write({'event': 'concurrency', 'workers': workers, 'previous_workers': previous_workers,
+                            'reason': reason})
+        if self.listener is not None:
+            self.listener('Concurrency %i -> %i (%s)' % (previous_workers, workers, reason))
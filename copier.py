@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import errno
+import fcntl
+import os
+import shutil
+import sys
+import uuid
+
+# Copies passthrough files (mp3/m4a) and cover art into the output folders with as little work as possible:
+#     identical     the destination already has the same content, nothing is written
+#     reflink       same file system with copy on write support (Linux: btrfs, XFS), the copy shares the data
+#                   blocks with the source until either of them is changed
+#     hardlink      same file system, only if enabled (the destination is the same file as the source, so anything
+#                   that modifies it, e.g. iTunes rewriting tags, modifies the source too)
+#     copy_file_range / sendfile
+#                   the kernel copies the data, without passing it through this process (Linux; copy_file_range may
+#                   also copy server side on NFS/SMB)
+#     userspace     plain read/write loop where none of the above is available
+
+# From <linux/fs.h>, _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+# Copied per call to copy_file_range()/sendfile().
+chunk_size = 64 * 1024 * 1024
+
+
+def same_content(source_path, destination_path):
+    """ True if destination_path exists and has exactly the same bytes as source_path. """
+    try:
+        if os.path.getsize(source_path) != os.path.getsize(destination_path):
+            return False
+    except OSError:
+        return False
+
+    with open(source_path, 'rb') as source, open(destination_path, 'rb') as destination:
+        while True:
+            source_block = source.read(1024 * 1024)
+            if source_block != destination.read(1024 * 1024):
+                return False
+            if not source_block:
+                return True
+
+
+def reflink(source_fd, destination_fd):
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+        return True
+    except OSError:
+        return False  # not supported by the file system, or different file systems
+
+
+def kernel_copy(source_fd, destination_fd, size):
+    """ Copy size bytes in the kernel, return the name of the method used or None if neither is available. """
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                if method == 'copy_file_range':
+                    count = os.copy_file_range(source_fd, destination_fd, min(chunk_size, size - copied))
+                else:
+                    count = os.sendfile(destination_fd, source_fd, copied, min(chunk_size, size - copied))
+                if count == 0:
+                    break
+                copied += count
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+            if copied:  # failed half way, start over with the next method
+                os.lseek(source_fd, 0, os.SEEK_SET)
+                os.lseek(destination_fd, 0, os.SEEK_SET)
+                os.ftruncate(destination_fd, 0)
+            continue
+        return method
+    return None
+
+
+def move_into_place(staging_path, destination_path, replace=True):
+    """ Rename staging_path to destination_path. Unless replace, FileExistsError if destination_path exists already.
+
+    Without replacing, the file is linked under its new name (which atomically fails if the name is taken) and then
+    removed under the old one. File systems without hard links (e.g. FAT) check for the destination before renaming.
+    """
+    if replace:
+        os.replace(staging_path, destination_path)
+        return
+    try:
+        os.link(staging_path, destination_path)
+    except FileExistsError:
+        raise FileExistsError(errno.EEXIST, 'Not overwriting the existing file', destination_path)
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EMLINK):
+            raise
+        if os.path.lexists(destination_path):
+            raise FileExistsError(errno.EEXIST, 'Not overwriting the existing file', destination_path)
+        os.replace(staging_path, destination_path)
+        return
+    os.remove(staging_path)
+
+
+def copy_file(source_path, destination_path, allow_hardlink=False, staging_dir=None, replace=True):
+    """ Copy source_path to destination_path (a file path, not a directory) and return how it was done.
+
+    The data goes into a hidden temporary file next to the destination, which is renamed to destination_path once it is
+    complete, so nobody watching the destination folder ever sees a half written file. A destination with the same
+    content is left alone. staging_dir replaces the destination folder as the place of the temporary file, it has to be
+    on the same file system. Without replace a destination with other content isn't overwritten, see move_into_place().
+
+    :param source_path: str
+    :param destination_path: str
+    :param allow_hardlink: bool
+    :param staging_dir: str or None
+    :param replace: bool
+    :return: str, one of 'identical', 'reflink', 'hardlink', 'copy_file_range', 'sendfile', 'userspace'
+    """
+    if same_content(source_path, destination_path):
+        return 'identical'
+
+    if staging_dir is None:
+        staging_dir = os.path.dirname(destination_path)
+    staging_path = os.path.join(staging_dir, '.transcode_%s.part' % uuid.uuid4().hex)
+
+    try:
+        if allow_hardlink:
+            try:
+                os.link(source_path, staging_path)
+                move_into_place(staging_path, destination_path, replace)
+                return 'hardlink'
+            except FileExistsError:
+                raise
+            except OSError:
+                # e.g. different file systems. Never write into a link to the source, that would overwrite the source.
+                if os.path.lexists(staging_path):
+                    os.remove(staging_path)
+
+        with open(source_path, 'rb') as source, open(staging_path, 'wb') as destination:
+            if reflink(source.fileno(), destination.fileno()):
+                method = 'reflink'
+            else:
+                method = kernel_copy(source.fileno(), destination.fileno(), os.fstat(source.fileno()).st_size)
+                if method is None:
+                    shutil.copyfileobj(source, destination, 1024 * 1024)
+                    method = 'userspace'
+        shutil.copymode(source_path, staging_path)
+        move_into_place(staging_path, destination_path, replace)
+    except BaseException:
+        try:
+            os.remove(staging_path)
+        except OSError:
+            pass
+        raise
+
+    return method
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import hashlib
+import os
+import uuid
+
+import copier
+import flacmeta
+
+# Cover art of an album, written to the cover art folder under the name of the album. Every folder of the album (the
+# album folder and its disc folders) contributes its cover file (folder.jpg, cover.png, ...), or if it has none the
+# first picture embedded in its FLAC files. Images are told apart by the hash of their content: a multi disc set with
+# the same cover in every disc folder gets a single file, different covers become "Album.jpg", "Album (2).jpg", ...
+
+# path is the image file, or the FLAC file that embeds picture (flacmeta.Picture, None for image files).
+CoverSource = namedtuple('CoverSource', ['path', 'picture'])
+
+
+def image_extension(data):
+    """ File extension of the image format of data (by its first bytes), '.jpg' if unknown. """
+    if data.startswith(b'\x89PNG'):
+        return '.png'
+    if data.startswith(b'GIF8'):
+        return '.gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    return '.jpg'
+
+
+def cover_file_order(path):
+    # folder.* before cover.*
+    return not os.path.basename(path).lower().startswith('folder'), path
+
+
+class AlbumCovers(object):
+    """ Cover candidates of one album, collected by the dispatcher while it scans the album. """
+
+    def __init__(self):
+        self.files = {}  # folder -> cover files
+        self.embedded = {}  # folder -> CoverSource of the first embedded picture
+
+    def add_file(self, path):
+        self.files.setdefault(os.path.dirname(path), []).append(path)
+
+    def wants_picture(self, flac_path):
+        """ True as long as the folder of flac_path has neither a cover file nor an embedded picture. """
+        folder = os.path.dirname(flac_path)
+        return folder not in self.files and folder not in self.embedded
+
+    def add_picture(self, flac_path, picture):
+        self.embedded.setdefault(os.path.dirname(flac_path), CoverSource(flac_path, picture))
+
+    def sources(self):
+        """ One source per folder, the album folder first. Cover files win over pictures, folder.* over cover.*. """
+        sources = []
+        for folder in sorted(set(self.files) | set(self.embedded)):
+            if folder in self.files:
+                path = min(self.files[folder], key=cover_file_order)
+                sources.append(CoverSource(path, None))
+            else:
+                sources.append(self.embedded[folder])
+        return sources
+
+
+def write_image(data, destination_path):
+    """ Write data to destination_path through a temporary file, like copier.copy_file(), return how it was done. """
+    try:
+        with open(destination_path, 'rb') as f:
+            if f.read() == data:
+                return 'identical'
+    except OSError:
+        pass
+
+    staging_path = os.path.join(os.path.dirname(destination_path), '.transcode_%s.part' % uuid.uuid4().hex)
+    try:
+        with open(staging_path, 'wb') as f:
+            f.write(data)
+        os.replace(staging_path, destination_path)
+    except BaseException:
+        try:
+            os.remove(staging_path)
+        except OSError:
+            pass
+        raise
+    return 'extracted'
+
+
+def write_covers(sources, output_dir, name, allow_hardlink=False):
+    """ Write every distinct image of sources to output_dir, named after the album.
+
+    :param sources: list of CoverSource, the first one gets the plain name
+    :param output_dir: str
+    :param name: str, name of the album
+    :param allow_hardlink: bool, see copier.copy_file()
+    :return: list of (CoverSource, destination path, method), method 'duplicate' for images written before
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    written = {}  # SHA-256 of the image -> destination path
+    results = []
+    for source in sources:
+        if source.picture is None:
+            with open(source.path, 'rb') as f:
+                data = f.read()
+        else:
+            data = flacmeta.read_picture_data(source.path, source.picture)
+
+        digest = hashlib.sha256(data).digest()
+        if digest in written:
+            results.append((source, written[digest], 'duplicate'))
+            continue
+
+        suffix = ' (%i)' % (len(written) + 1) if written else ''
+        destination_path = os.path.join(output_dir, name + suffix + image_extension(data))
+        if source.picture is None:
+            method = copier.copy_file(source.path, destination_path, allow_hardlink)
+        else:
+            method = write_image(data, destination_path)
+        written[digest] = destination_path
+        results.append((source, destination_path, method))
+    return results
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import signal
+import threading
+import time
+
+from jobqueue import folder_signature, JobQueue
+from runlog import format_summary, NullRunLog, RunLog
+import transcode
+from watcher import create_watcher, list_entries
+
+# Headless mode for a server without a display: album folders dropped into a folder are transcoded as soon as they are
+# complete, e.g.
+#     python3 daemon.py /srv/ingest/drop --output-dir /srv/ingest/mp3 --cover-dir /srv/ingest/covers
+#
+# Every folder directly inside the drop folder is one album (which may contain CD1/CD2 subfolders). A folder counts as
+# complete once nothing changed in it for --settle seconds. Completed folders go into an on-disk job queue and are
+# handed to the same scheduler as used by transcode.py, while the drop folder is still being watched.
+
+queue_path = os.path.join(os.path.expanduser('~'), '.transcode', 'queue.sqlite3')
+
+
+class WatchFolderDaemon(object):
+    def __init__(self, drop_dir, job_queue, settle_seconds=30.0, poll_interval=5.0, use_inotify=True, workers=None):
+        self.drop_dir = os.path.abspath(drop_dir)
+        self.job_queue = job_queue
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.workers = workers
+
+        self.stopping = threading.Event()
+
+        # Top level name -> [time of the last change, signature at that time or None]
+        self.settling = {}
+
+    def run(self):
+        pending_count = self.job_queue.pending_count()
+        if pending_count:
+            print('Continuing with %i folders queued before' % pending_count)
+
+        transcode_thread = threading.Thread(target=self.transcode_jobs)
+        transcode_thread.start()
+        try:
+            self.watch()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            transcode_thread.join()
+
+    def stop(self):
+        self.stopping.set()
+
+    def watch(self):
+        watcher = create_watcher(self.drop_dir, self.poll_interval, self.use_inotify)
+        try:
+            # Folders that arrived while the daemon wasn't running. Folders done before are recognized by their
+            # signature and not queued again.
+            for name in list_entries(self.drop_dir):
+                self.settling[name] = [time.monotonic(), None]
+
+            print('Watching "%s" (%s)' % (self.drop_dir, type(watcher).__name__))
+            while not self.stopping.is_set():
+                for name in watcher.changes(timeout=min(1.0, self.settle_seconds)):
+                    if os.path.isdir(os.path.join(self.drop_dir, name)):
+                        entry = self.settling.setdefault(name, [0.0, None])
+                        entry[0] = time.monotonic()
+                    else:
+                        self.settling.pop(name, None)
+
+                self.enqueue_settled(watcher.reports_file_changes)
+        finally:
+            watcher.close()
+
+    def enqueue_settled(self, reports_file_changes):
+        now = time.monotonic()
+        for name, entry in list(self.settling.items()):
+            last_change, signature = entry
+            if now - last_change < self.settle_seconds:
+                continue
+
+            folder_path = os.path.join(self.drop_dir, name)
+            current_signature = folder_signature(folder_path)
+            if not reports_file_changes and current_signature != signature:
+                # Without file events the only way to tell is to compare with the previous check.
+                entry[:] = [now, current_signature]
+                continue
+
+            del self.settling[name]
+            if self.job_queue.put(folder_path, current_signature):
+                print('Queued "%s"' % name)
+
+    def transcode_jobs(self):
+        # One scheduler for all albums, the next album is started while the last tracks of the previous one are still
+        # encoding.
+        run_log = RunLog(transcode.run_log_path) if transcode.run_log_path else NullRunLog()
+        scheduler = transcode.create_scheduler(self.workers, run_log)
+        try:
+            while not self.stopping.is_set():
+                # Don't take more jobs out of the on-disk queue than the pool can start soon.
+                if not scheduler.has_capacity():
+                    self.stopping.wait(0.2)
+                    continue
+
+                job = self.job_queue.take(timeout=1.0)
+                if job is None:
+                    continue
+
+                if not os.path.isdir(job.path):
+                    self.job_queue.finish(job.job_id, 'Folder is gone')
+                    continue
+
+                print('Transcoding "%s" ...' % job.path)
+                transcode.refresh_settings()
+                scheduler.submit(job.path, listener=lambda album, message, job=job: self.report(job, album, message))
+        finally:
+            # Cancels the albums still running, they are queued again on the next start.
+            summary = scheduler.shutdown()
+            if summary is not None:
+                print(format_summary(summary))
+
+    def report(self, job, album, message):
+        if message is not None:
+            print(message)
+        elif album.cancelled:
+            # Stopped half way, continue with it on the next start.
+            print('Cancelled "%s"' % job.path)
+            self.job_queue.release(job.job_id)
+        elif album.errors:
+            # Not done, so the folder is queued again the next time it changes or the daemon starts.
+            print('Failed "%s": %i errors' % (job.path, len(album.errors)))
+            path, error = album.errors[0]
+            self.job_queue.finish(job.job_id, '%i failed, first "%s": %s' % (len(album.errors), path, error))
+        else:
+            print('Finished "%s"' % job.path)
+            self.job_queue.finish(job.job_id)
+
+
+def process_cl_args():
+    parser = argparse.ArgumentParser(description='Transcode album folders as they arrive in a drop folder.')
+    parser.add_argument('drop_dir', help='folder to watch, every folder inside of it is one album')
+    parser.add_argument('--output-dir', default=transcode.itunes_import_dir, help='where the mp3 files are written')
+    parser.add_argument('--cover-dir', default=transcode.cover_art_output_dir, help='where folder.jpg is copied to')
+    parser.add_argument('--index', default=transcode.index_path, help='transcode index (sqlite3)')
+    parser.add_argument('--queue', default=queue_path, help='job queue (sqlite3)')
+    parser.add_argument('--settle', type=float, default=30.0,
+                        help='seconds without changes after which a folder counts as complete (default: 30)')
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+                        help='seconds between two listings of the drop folder when polling (default: 5)')
+    parser.add_argument('--poll', action='store_true', help='poll even if inotify is available')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of files to transcode at the same time (default: adjusted to the load)')
+    parser.add_argument('--run-log', default=None,
+                        help='write per file, per stage timings as JSON lines to this file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_cl_args()
+
+    # The same settings as used by transcode.py, pointed at the directories of this machine.
+    transcode.itunes_import_dir = args.output_dir
+    transcode.cover_art_output_dir = args.cover_dir
+    transcode.index_path = args.index
+    transcode.run_log_path = args.run_log
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    job_queue = JobQueue(args.queue)
+    daemon = WatchFolderDaemon(args.drop_dir, job_queue, settle_seconds=args.settle, poll_interval=args.poll_interval,
+                               use_inotify=not args.poll, workers=args.workers)
+
+    # Stopped by systemd or kill: finish cleanly, the interrupted folder is queued again.
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: daemon.stop())
+    try:
+        daemon.run()
+    finally:
+        job_queue.close()
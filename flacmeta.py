@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import os
+import struct
+import subprocess
+
+from pipeline import find_binary
+
+# Reads the metadata blocks at the start of a FLAC file (https://xiph.org/flac/format.html) in a single pass, without
+# starting metaflac for every single tag. Only the blocks needed for transcoding are parsed, everything else (seek
+# table, padding, the audio frames, the image data of pictures) is skipped over.
+
+metaflac_binary = find_binary('metaflac')
+
+BLOCK_STREAMINFO = 0
+BLOCK_VORBIS_COMMENT = 4
+BLOCK_PICTURE = 6
+
+StreamInfo = namedtuple('StreamInfo', ['sample_rate', 'channels', 'bits_per_sample', 'total_samples', 'md5'])
+
+Picture = namedtuple('Picture', ['picture_type', 'mime', 'description', 'width', 'height',
+                                 'data_offset', 'data_length'])
+
+
+class FlacFormatError(Exception):
+    pass
+
+
+class FlacMetadata(object):
+    def __init__(self):
+        self.streaminfo = None
+        self.vendor = ''
+        self.tags = {}  # upper case field name -> list of values
+        self.pictures = []
+
+    def tag(self, name):
+        """ Return the first value of a Vorbis comment field, or an empty string if the field isn't present. """
+        values = self.tags.get(name.upper())
+        return values[0] if values else ''
+
+    @property
+    def duration(self):
+        """ Length of the audio in seconds, 0 if unknown. """
+        if self.streaminfo is None or not self.streaminfo.sample_rate:
+            return 0.0
+        return self.streaminfo.total_samples / self.streaminfo.sample_rate
+
+    @property
+    def first_picture(self):
+        """ The first embedded picture with image data (not only a link to one), or None. """
+        for picture in self.pictures:
+            if picture.data_length and picture.mime != '-->':
+                return picture
+        return None
+
+
+def skip_id3v2(f):
+    # Some taggers put an ID3v2 tag in front of the "fLaC" marker. Its size is stored as a 28 bit syncsafe integer.
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b'ID3':
+        size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        if header[5] & 0x10:  # footer present
+            size += 10
+        f.seek(10 + size)
+    else:
+        f.seek(0)
+
+
+def read_exactly(f, length):
+    data = f.read(length)
+    if len(data) != length:
+        raise FlacFormatError('Unexpected end of file in metadata block')
+    return data
+
+
+def parse_streaminfo(data):
+    if len(data) < 34:
+        raise FlacFormatError('STREAMINFO block too short')
+    # Bytes 10-17 hold sample rate (20 bits), channels - 1 (3 bits), bits per sample - 1 (5 bits), total samples (36).
+    packed = int.from_bytes(data[10:18], 'big')
+    return StreamInfo(sample_rate=packed >> 44,
+                      channels=((packed >> 41) & 0x07) + 1,
+                      bits_per_sample=((packed >> 36) & 0x1f) + 1,
+                      total_samples=packed & 0xfffffffff,
+                      md5=data[18:34].hex())
+
+
+def parse_vorbis_comment(data, metadata):
+    # Unlike the rest of FLAC, the Vorbis comment block uses little endian lengths.
+    try:
+        offset = 0
+        vendor_length, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        metadata.vendor = data[offset:offset + vendor_length].decode('utf-8', 'replace')
+        offset += vendor_length
+        comment_count, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        for _ in range(comment_count):
+            comment_length, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            comment = data[offset:offset + comment_length].decode('utf-8', 'replace')
+            offset += comment_length
+            name, separator, value = comment.partition('=')
+            if separator:
+                metadata.tags.setdefault(name.upper(), []).append(value)
+    except struct.error:
+        raise FlacFormatError('VORBIS_COMMENT block is truncated')
+
+
+def read_picture_header(f, block_start, block_length):
+    # Read the descriptive fields of a PICTURE block, but only remember where the image data is.
+    picture_type, mime_length = struct.unpack('>II', read_exactly(f, 8))
+    mime = read_exactly(f, mime_length).decode('ascii', 'replace')
+    description_length, = struct.unpack('>I', read_exactly(f, 4))
+    description = read_exactly(f, description_length).decode('utf-8', 'replace')
+    width, height, depth, colors, data_length = struct.unpack('>IIIII', read_exactly(f, 20))
+    data_offset = f.tell()
+    if data_offset + data_length > block_start + block_length:
+        raise FlacFormatError('PICTURE block is truncated')
+    return Picture(picture_type, mime, description, width, height, data_offset, data_length)
+
+
+def read_metadata(in_file_path):
+    """ Read STREAMINFO, all Vorbis comments and the picture descriptions of a FLAC file in one pass.
+
+    :param in_file_path: str
+    :return: FlacMetadata
+    """
+    metadata = FlacMetadata()
+
+    with open(in_file_path, 'rb') as f:
+        skip_id3v2(f)
+        if f.read(4) != b'fLaC':
+            raise FlacFormatError('"%s" is not a FLAC file' % in_file_path)
+
+        last_block = False
+        while not last_block:
+            block_header = read_exactly(f, 4)
+            last_block = bool(block_header[0] & 0x80)
+            block_type = block_header[0] & 0x7f
+            block_length = int.from_bytes(block_header[1:], 'big')
+            block_start = f.tell()
+
+            if block_type == BLOCK_STREAMINFO:
+                metadata.streaminfo = parse_streaminfo(read_exactly(f, block_length))
+            elif block_type == BLOCK_VORBIS_COMMENT:
+                parse_vorbis_comment(read_exactly(f, block_length), metadata)
+            elif block_type == BLOCK_PICTURE:
+                metadata.pictures.append(read_picture_header(f, block_start, block_length))
+            elif block_type == 127:
+                raise FlacFormatError('Invalid metadata block type')
+
+            f.seek(block_start + block_length)
+
+    if metadata.streaminfo is None:
+        raise FlacFormatError('"%s" has no STREAMINFO block' % in_file_path)
+
+    return metadata
+
+
+def read_streaminfo(in_file_path):
+    """ Read only the STREAMINFO block, which the format requires to be the very first metadata block.
+
+    :param in_file_path: str
+    :return: StreamInfo
+    """
+    with open(in_file_path, 'rb') as f:
+        skip_id3v2(f)
+        if f.read(4) != b'fLaC':
+            raise FlacFormatError('"%s" is not a FLAC file' % in_file_path)
+        block_header = read_exactly(f, 4)
+        if block_header[0] & 0x7f != BLOCK_STREAMINFO:
+            raise FlacFormatError('"%s" has no STREAMINFO block' % in_file_path)
+        return parse_streaminfo(read_exactly(f, int.from_bytes(block_header[1:], 'big')))
+
+
+def read_duration(in_file_path):
+    """ Length of the audio in seconds according to STREAMINFO.
+
+    Used to estimate how long a file takes to transcode. If the file can't be parsed (or doesn't state its length) the
+    length is guessed from the file size, assuming a typical compressed CD audio rate of about 100 kB per second. A file
+    that can't be read at all counts as 0, transcoding it reports the error.
+    """
+    try:
+        streaminfo = read_streaminfo(in_file_path)
+        if streaminfo.sample_rate and streaminfo.total_samples:
+            return streaminfo.total_samples / streaminfo.sample_rate
+    except FlacFormatError:
+        pass
+    except OSError:
+        return 0.0
+    try:
+        return os.path.getsize(in_file_path) / 100000
+    except OSError:
+        return 0.0
+
+
+def read_duration_and_picture(in_file_path):
+    """ read_duration() and the first embedded picture (None if there is none) in one pass over the metadata.
+
+    :param in_file_path: str
+    :return: (float, Picture or None)
+    """
+    try:
+        metadata = read_metadata(in_file_path)
+    except (FlacFormatError, OSError):
+        return read_duration(in_file_path), None
+    return metadata.duration or os.path.getsize(in_file_path) / 100000, metadata.first_picture
+
+
+def read_picture_data(in_file_path, picture):
+    with open(in_file_path, 'rb') as f:
+        f.seek(picture.data_offset)
+        return read_exactly(f, picture.data_length)
+
+
+def read_tags_metaflac(in_file_path, metaflac_strings):
+    """ Fallback for files the native reader doesn't understand: a single metaflac call for all tags. """
+    command = [metaflac_binary]
+    command += ['--show-tag=%s' % metaflac_string for metaflac_string in metaflac_strings]
+    command += [in_file_path]
+    metaflac_tag = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    get_tag_out, get_tag_err = metaflac_tag.communicate()
+
+    tags = {metaflac_string: '' for metaflac_string in metaflac_strings}
+    for line in get_tag_out.decode('utf-8').splitlines():  # bytes to UTF-8 string
+        name, separator, value = line.partition('=')
+        for metaflac_string in metaflac_strings:
+            if separator and name.upper() == metaflac_string.upper() and not tags[metaflac_string]:
+                tags[metaflac_string] = value
+    return tags
+
+
+def read_tags(in_file_path, metaflac_strings):
+    """ Return the first value of each of the given Vorbis comment fields, an empty string for missing fields.
+
+    :param in_file_path: str
+    :param metaflac_strings: list of str
+    :return: dict
+    """
+    try:
+        metadata = read_metadata(in_file_path)
+    except FlacFormatError:
+        return read_tags_metaflac(in_file_path, metaflac_strings)
+    return {metaflac_string: metadata.tag(metaflac_string) for metaflac_string in metaflac_strings}
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+from PyQt5.QtCore import pyqtSignal, QTimer
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QMessageBox
+
+from runlog import NullRunLog, RunLog
+import transcode
+
+# The window of main.py. Only imported when the GUI is launched, so the command line and the daemon never load Qt.
+
+
+class DragDropWidget(QWidget):
+    def __init__(self, parent):
+        super().__init__()
+        self.parent = parent
+        self.setAcceptDrops(True)
+
+    def dragEnterEvent(self, e):
+        if e.mimeData().hasFormat('text/uri-list'):
+            self.parent.statusBar().showMessage('Drop now ...')
+            e.accept()
+        else:
+            self.parent.statusBar().showMessage('')
+            e.ignore()
+
+    def dragLeaveEvent(self, e):
+        self.parent.statusBar().showMessage('')
+
+    def dropEvent(self, e):
+        if e.mimeData().text().startswith('file://'):  # TODO does this also work for any mix of file(s) and folder(s)?
+            input_dir = e.mimeData().text()[len('file://'):]
+            if os.path.isdir(input_dir):
+                self.parent.start_transcoding(input_dir)
+            else:
+                self.parent.statusBar().showMessage('Not a directory')
+
+
+class DragDropWindow(QMainWindow):
+    # Emitted from the threads of the scheduler. Qt delivers them to the slots in the GUI thread (queued connection), so
+    # widgets are only ever touched from the GUI thread.
+    status_changed = pyqtSignal(str)
+    transcode_finished = pyqtSignal(object)
+
+    # Status updates arriving faster than this are coalesced, only the latest one is shown.
+    status_interval_ms = 100
+
+    def __init__(self, *args, workers=None, run_log_path=None, profile_path=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.init_ui()
+
+        # Number of files transcoded at the same time, None adjusts it to the load (starting with one per core).
+        self.workers = workers
+
+        # Optional per file, per stage timings (JSON lines) and cProfile statistics of the dispatching thread.
+        self.run_log_path = run_log_path
+        self.profile_path = profile_path
+
+        # Created on the first drop. All dropped folders share its pool, so dropping several albums in a row doesn't
+        # start more processes than there are workers. Every album has its own cancel token and progress.
+        self.scheduler = None
+
+        # Latest status not shown yet. The timer blocks further repaints of the status bar for status_interval_ms.
+        self.pending_status = None
+        self.status_timer = QTimer(self)
+        self.status_timer.setSingleShot(True)
+        self.status_timer.setInterval(self.status_interval_ms)
+        self.status_timer.timeout.connect(self.show_pending_status)
+
+        self.status_changed.connect(self.queue_status)
+        self.transcode_finished.connect(self.on_transcode_finished)
+
+    def init_ui(self):
+        self.setGeometry(100, 100, 200, 200)
+        self.setWindowTitle('Transcode')
+
+        button_widget = DragDropWidget(self)
+        self.setCentralWidget(button_widget)
+
+        self.statusBar().showMessage('Drop folder here.')
+
+        self.show()
+
+    @property
+    def active_transcode(self):
+        # Are we transcoding in this very moment? Closing frame while transcoding opens a confirmation message box.
+        return self.scheduler is not None and len(self.scheduler.active_albums()) > 0
+
+    def closeEvent(self, event):
+        if self.active_transcode:
+            confirmation_message_box = QMessageBox()
+            result = confirmation_message_box.question(self,
+                                                       'Confirmation',
+                                                       'Are you sure you want to cancel transcoding?',
+                                                       QMessageBox.Yes | QMessageBox.No)
+            event.ignore()
+            if result == QMessageBox.Yes:
+                self.scheduler.cancel_all()
+        else:
+            if self.scheduler is not None:
+                self.scheduler.shutdown()
+                self.scheduler = None
+            event.accept()
+
+    def create_scheduler(self):
+        # The same settings as the command line, from transcode.py.
+        run_log = RunLog(self.run_log_path, self.profile_path) if self.run_log_path else NullRunLog()
+        return transcode.create_scheduler(self.workers, run_log)
+
+    def start_transcoding(self, input_dir):
+        transcode.refresh_settings()
+        if self.scheduler is None:
+            self.scheduler = self.create_scheduler()
+
+        # The scheduler scans and transcodes the folder in its own threads, it reports back through the signals.
+        self.scheduler.submit(input_dir, listener=self.on_album_changed)
+
+    def on_album_changed(self, album, message):
+        if message is None:
+            self.transcode_finished.emit(album)
+        elif album.scanning:
+            # The total isn't known before the scan is done.
+            self.status_changed.emit('%s: Scanning, %s, %i workers' % (album.name, album.progress,
+                                                                        self.scheduler.workers))
+        else:
+            self.status_changed.emit('%s: %s, %i workers' % (album.name, album.progress, self.scheduler.workers))
+
+    def queue_status(self, message):
+        self.pending_status = message
+        if not self.status_timer.isActive():
+            self.show_pending_status()
+
+    def show_pending_status(self):
+        if self.pending_status is not None:
+            self.statusBar().showMessage(self.pending_status)
+            self.pending_status = None
+            self.status_timer.start()
+
+    def on_transcode_finished(self, album):
+        if self.active_transcode:
+            return  # other albums are still going, they keep updating the status bar
+
+        self.status_timer.stop()
+        self.pending_status = None
+        if album.cancelled:
+            self.statusBar().showMessage('Cancelled. Ready for next folder.')
+        else:
+            self.statusBar().showMessage('Done. Ready for next folder.')
+
+
+def run_gui(qt_args, workers=None, run_log_path=None, profile_path=None):
+    """ Show the window and run the Qt event loop until it is closed, return the exit code. """
+    app = QApplication(qt_args)
+    window = DragDropWindow(workers=workers, run_log_path=run_log_path, profile_path=profile_path)
+    window.show()
+    return app.exec_()
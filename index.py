@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import urllib.request
+
+import flacmeta
+
+
+class TranscodeIndex(object):
+    """ Remembers which source files were already transcoded (or copied) and with which encoder settings.
+
+    Entries are keyed by the absolute source path and the encoder settings. A source counts as unchanged if its size,
+    its modification time and (for FLAC files) the MD5 of the decoded audio from STREAMINFO still match. Looking up a
+    file therefore costs one stat, one small read of the file header and one primary key lookup.
+
+    Changing the encoder settings doesn't remove anything, entries with the old settings simply don't match anymore.
+    The produced output files are not checked, as iTunes moves them away from the import folder after importing.
+
+    A read_only index (for a dry run) writes nothing, not even the index file: a missing index is simply empty.
+    """
+
+    def __init__(self, index_path, read_only=False):
+        # The workers of the pool record their results from several threads.
+        self.lock = threading.Lock()
+        self.connection = None
+        if read_only:
+            if os.path.exists(index_path):
+                # Without a WAL file nobody else has the index open and it can be read as a plain file. Otherwise even
+                # a read-only connection would create the shared memory file of the WAL.
+                mode = 'ro' if os.path.exists(index_path + '-wal') else 'ro&immutable=1'
+                uri = 'file:%s?mode=%s' % (urllib.request.pathname2url(os.path.abspath(index_path)), mode)
+                self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            return
+
+        index_dir = os.path.dirname(index_path)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS transcoded ('
+                                    'source TEXT NOT NULL, '
+                                    'settings TEXT NOT NULL, '
+                                    'size INTEGER NOT NULL, '
+                                    'mtime_ns INTEGER NOT NULL, '
+                                    'md5 TEXT NOT NULL, '
+                                    'output TEXT NOT NULL, '
+                                    'PRIMARY KEY (source, settings))')
+            self.connection.commit()
+
+    @staticmethod
+    def fingerprint(source_path):
+        stat = os.stat(source_path)
+
+        md5 = ''
+        if source_path.endswith('.flac'):
+            try:
+                md5 = flacmeta.read_streaminfo(source_path).md5
+            except flacmeta.FlacFormatError:
+                pass
+
+        return stat.st_size, stat.st_mtime_ns, md5
+
+    def is_current(self, source_path, settings):
+        """ Check if source_path was already processed with exactly these settings and didn't change since. """
+        if self.connection is None:
+            return False
+        source_path = os.path.abspath(source_path)
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime_ns, md5 FROM transcoded '
+                                          'WHERE source = ? AND settings = ?', (source_path, settings)).fetchone()
+        if row is None:
+            return False
+
+        try:
+            return tuple(row) == self.fingerprint(source_path)
+        except OSError:
+            return False
+
+    def is_output_of(self, output_path, source_path):
+        """ Check if output_path was written for source_path before (with any settings). """
+        if self.connection is None:
+            return False
+        source_path = os.path.abspath(source_path)
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM transcoded WHERE source = ? AND output = ? LIMIT 1',
+                                          (source_path, output_path)).fetchone()
+        return row is not None
+
+    def record(self, source_path, settings, output_path):
+        source_path = os.path.abspath(source_path)
+        size, mtime_ns, md5 = self.fingerprint(source_path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO transcoded (source, settings, size, mtime_ns, md5, output) '
+                                    'VALUES (?, ?, ?, ?, ?, ?)',
+                                    (source_path, settings, size, mtime_ns, md5, output_path))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import os
+import sqlite3
+import threading
+import time
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+QueuedJob = namedtuple('QueuedJob', ['job_id', 'path', 'signature'])
+
+
+class JobQueue(object):
+    """ Album folders waiting to be transcoded, stored on disk so nothing is lost if the daemon stops or crashes.
+
+    Every state change is committed before it takes effect (synchronous=FULL, so also across a power loss). Jobs that
+    were still running when the daemon stopped are queued again on the next start. Transcoding a folder a second time
+    is cheap, files that were finished before are skipped by the transcode index.
+
+    A folder is only queued again if it changed since it was queued or done the last time, i.e. if its signature (see
+    folder_signature()) differs.
+    """
+
+    def __init__(self, queue_path):
+        queue_dir = os.path.dirname(queue_path)
+        if queue_dir and not os.path.isdir(queue_dir):
+            os.makedirs(queue_dir)
+
+        # Filled from the watching thread, emptied from the transcoding thread.
+        self.lock = threading.Lock()
+        self.job_available = threading.Condition(self.lock)
+        self.connection = sqlite3.connect(queue_path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=FULL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                                    'job_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                    'path TEXT NOT NULL, '
+                                    'signature TEXT NOT NULL, '
+                                    'state TEXT NOT NULL, '
+                                    'error TEXT, '
+                                    'queued_at REAL NOT NULL, '
+                                    'finished_at REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_path ON jobs (path)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, job_id)')
+
+            # Interrupted by a crash (or being stopped), start them again.
+            self.connection.execute('UPDATE jobs SET state = ? WHERE state = ?', (STATE_QUEUED, STATE_RUNNING))
+            self.connection.commit()
+
+    def put(self, path, signature):
+        """ Queue path, unless it is queued already or was processed before with the same signature.
+
+        :param path: str
+        :param signature: str
+        :return: bool, True if a new job was queued
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            queued = self.connection.execute('SELECT job_id FROM jobs WHERE path = ? AND state = ?',
+                                             (path, STATE_QUEUED)).fetchone()
+            if queued is not None:
+                # Still waiting, it will see the changed folder anyway.
+                self.connection.execute('UPDATE jobs SET signature = ? WHERE job_id = ?', (signature, queued[0]))
+                self.connection.commit()
+                return False
+
+            latest = self.connection.execute('SELECT signature, state FROM jobs WHERE path = ? AND state != ? '
+                                             'ORDER BY job_id DESC LIMIT 1', (path, STATE_FAILED)).fetchone()
+            if latest is not None and latest[0] == signature:
+                return False
+
+            self.connection.execute('INSERT INTO jobs (path, signature, state, queued_at) VALUES (?, ?, ?, ?)',
+                                    (path, signature, STATE_QUEUED, time.time()))
+            self.connection.commit()
+            self.job_available.notify()
+            return True
+
+    def take(self, timeout=None):
+        """ Mark the oldest queued job as running and return it, None if there was none within timeout seconds.
+
+        :return: QueuedJob or None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while True:
+                row = self.connection.execute('SELECT job_id, path, signature FROM jobs WHERE state = ? '
+                                              'ORDER BY job_id LIMIT 1', (STATE_QUEUED,)).fetchone()
+                if row is not None:
+                    self.connection.execute('UPDATE jobs SET state = ? WHERE job_id = ?', (STATE_RUNNING, row[0]))
+                    self.connection.commit()
+                    return QueuedJob(*row)
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.job_available.wait(remaining)
+
+    def finish(self, job_id, error=None):
+        state = STATE_DONE if error is None else STATE_FAILED
+        with self.lock:
+            self.connection.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE job_id = ?',
+                                    (state, error, time.time(), job_id))
+            self.connection.commit()
+
+    def release(self, job_id):
+        """ Put a job that was interrupted back into the queue, ahead of the ones queued after it. """
+        with self.lock:
+            self.connection.execute('UPDATE jobs SET state = ? WHERE job_id = ?', (STATE_QUEUED, job_id))
+            self.connection.commit()
+            self.job_available.notify()
+
+    def pending_count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM jobs WHERE state = ?', (STATE_QUEUED,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def folder_signature(folder_path):
+    """ Number of files, their total size and the latest modification time below folder_path, as a string.
+
+    Changes as long as files are still being copied into the folder, and if files are added or replaced later on.
+    """
+    file_count = 0
+    total_size = 0
+    latest_mtime_ns = 0
+
+    pending_dirs = [folder_path]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        file_count += 1
+                        total_size += stat.st_size
+                        latest_mtime_ns = max(latest_mtime_ns, stat.st_mtime_ns)
+        except OSError:
+            continue
+
+    return '%i:%i:%i' % (file_count, total_size, latest_mtime_ns)
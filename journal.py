@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+
+
+def journal_header(roots, settings):
+    return {'event': 'start', 'roots': sorted(os.path.abspath(root) for root in roots), 'settings': settings}
+
+
+def read_journal(journal_path, roots, settings):
+    """ Return the files done by an unfinished previous run over the same roots with the same settings.
+
+    None if there is nothing to resume: no journal, a journal of other roots or settings, or the run finished.
+
+    :param journal_path: str
+    :param roots: list of str
+    :param settings: str
+    :return: set of str or None
+    """
+    try:
+        with open(journal_path, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue  # torn write of the last line
+
+    if not records or records[0].get('event') != 'start':
+        return None
+    header = dict(records[0])
+    header.pop('time', None)
+    if header != journal_header(roots, settings):
+        return None
+    if any(record.get('event') == 'finished' for record in records):
+        return None
+
+    return {record['path'] for record in records if record.get('event') == 'done'}
+
+
+class Journal(object):
+    """ Checkpoint journal of a batch run: which files of the plan are done, so a run that was killed can be resumed.
+
+    The journal is a JSON lines file. The first line describes the run (roots and encoder settings), every further line
+    is a file that was finished, written and flushed as soon as it is finished. A line that was only half written when
+    the process died is ignored on reading.
+
+    With done (as returned by read_journal()) the existing journal is continued, otherwise a new one is started.
+    """
+
+    # Files recorded between two fsync() calls. Flushed lines survive the process being killed anyway, fsync() only
+    # matters if the machine goes down.
+    sync_interval = 100
+
+    def __init__(self, journal_path, roots, settings, done=None):
+        journal_dir = os.path.dirname(journal_path)
+        if journal_dir and not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        if done is not None:
+            self.journal_file = open(journal_path, 'a')
+        else:
+            self.journal_file = open(journal_path, 'w')
+            self.write(dict(journal_header(roots, settings), time=time.time()))
+
+    def write(self, record):
+        self.journal_file.write(json.dumps(record) + '\n')
+        self.journal_file.flush()
+
+    def record(self, path, action):
+        with self.lock:
+            self.write({'event': 'done', 'path': path, 'action': action})
+            self.unsynced += 1
+            if self.unsynced >= self.sync_interval:
+                os.fsync(self.journal_file.fileno())
+                self.unsynced = 0
+
+    def finish(self):
+        """ Mark the run as complete, the next run over the same roots starts over instead of resuming. """
+        with self.lock:
+            self.write({'event': 'finished', 'time': time.time()})
+
+    def close(self):
+        with self.lock:
+            os.fsync(self.journal_file.fileno())
+            self.journal_file.close()
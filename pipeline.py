@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import errno
+import fcntl
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from cancel import CancelToken
+import copier
+from runlog import NullRunLog
+
+# Where Homebrew and MacPorts install programs, which GUI applications on macOS don't have on their PATH.
+extra_binary_dirs = ['/usr/local/bin', '/opt/homebrew/bin', '/opt/local/bin']
+
+
+def find_binary(name):
+    """ Full path of the program name on the PATH or in extra_binary_dirs, name itself if it isn't found. """
+    return shutil.which(name) or shutil.which(name, path=os.pathsep.join(extra_binary_dirs)) or name
+
+
+flac_binary = find_binary('flac')
+nice_binary = find_binary('nice')
+ionice_binary = find_binary('ionice')
+
+# Priority of the flac/lame/ffmpeg processes: nice_level is added to their niceness (0-19), ionice_class ('best-effort'
+# with ionice_level 0-7, or 'idle', None leaves it alone) sets their I/O priority (Linux only).
+nice_level = 0
+ionice_class = None
+ionice_level = 4
+
+# Size of the pipe between decoder and encoder. A larger pipe lets flac run further ahead of lame, so both processes
+# block less often. Only applied where the OS allows resizing pipes (Linux), elsewhere the default size is kept.
+pipe_buffer_size = 1024 * 1024
+
+# Read from flac and passed on to every encoder at once when fanning out to several profiles.
+fan_out_chunk_size = 256 * 1024
+
+# Linux only, Python exposes the constant from 3.10 on.
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+def set_pipe_size(fd, size):
+    if not size or not sys.platform.startswith('linux'):
+        return
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        pass  # e.g. larger than /proc/sys/fs/pipe-max-size for unprivileged users
+
+
+def with_priority(command):
+    """ Prefix command with nice/ionice if the processes are to get a lower priority.
+
+    Both exec the command, so it keeps the process (and process group) they were started in.
+    """
+    prefix = []
+    if ionice_class and sys.platform.startswith('linux') and shutil.which(ionice_binary):
+        prefix += [ionice_binary, '-c', '3' if ionice_class == 'idle' else '2']
+        if ionice_class != 'idle':
+            prefix += ['-n', str(ionice_level)]
+    if nice_level:
+        prefix += [nice_binary, '-n', str(nice_level)]
+    return prefix + command
+
+
+def commit_file(staging_path, output_file_path, replace=False):
+    """ Rename the finished staging file to output_file_path.
+
+    An existing file at output_file_path is only replaced with replace (i.e. it is a previous output of the same
+    source), otherwise FileExistsError is raised: all albums share the output folder, and iTunes picks files up from
+    there, so another file of the same name is never overwritten.
+
+    A staging file on another file system (e.g. a staging folder on a tmpfs) is copied next to the destination first,
+    so the file still appears at output_file_path in one atomic step.
+    """
+    try:
+        copier.move_into_place(staging_path, output_file_path, replace)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copier.copy_file(staging_path, output_file_path, replace=replace)
+        os.remove(staging_path)
+
+
+def record_exit(process, start, run_log, input_file_path):
+    process.wait()
+    run_log.record(input_file_path, 'decode', time.perf_counter() - start, os.path.getsize(input_file_path))
+
+
+def staging_path_for(output_file_path, staging_dir):
+    # Not created in advance (like tempfile.mkstemp would), so the encoder creates it with the usual permissions.
+    if staging_dir is None:
+        staging_dir = os.path.dirname(output_file_path)
+    return os.path.join(staging_dir, '.transcode_%s.part' % uuid.uuid4().hex)
+
+
+def transcode(input_file_path, outputs, tags, buffer_size=None, cancel_token=None, run_log=None, committed=None,
+              replaceable=()):
+    """ Decode a FLAC file with flac once and encode it with the encoder of every output profile.
+
+    All programs are started directly (no shell in between). With a single profile flac and the encoder are connected by
+    a pipe. With several the decoded audio is read once and passed on to all encoders, which run in parallel.
+
+    Each encoder writes into a hidden temporary file, which is renamed to the output file path once flac and the encoder
+    succeeded. The rename is atomic as it never crosses a file system, so every file is written exactly once and nobody
+    watching a destination directory (e.g. iTunes) ever sees a half written file. On failure the temporary file is
+    removed. The outputs that succeeded are kept (and passed to committed) even if another encoder failed, the first
+    error is raised after all of them finished.
+
+    All processes get their own process group and are registered with cancel_token, which kills them if the run is
+    cancelled. Cancelled is raised in that case.
+
+    Existing output files are only overwritten if they are in replaceable, see commit_file().
+
+    With a run_log the decode, encode and commit stages of the file are recorded.
+
+    :param input_file_path: str
+    :param outputs: list of (OutputProfile, output file path, staging dir), the staging dir (None for the directory of
+                    the output file) has to be on the same file system as the output file
+    :param tags: dict, as returned by get_tags()
+    :param buffer_size: int, size of the pipes in bytes, None uses pipe_buffer_size
+    :param cancel_token: CancelToken or None
+    :param run_log: RunLog or None
+    :param committed: callable(OutputProfile, output file path) or None, called for every output that was written
+    :param replaceable: collection of the output file paths that may be overwritten
+    """
+    if buffer_size is None:
+        buffer_size = pipe_buffer_size
+    if cancel_token is None:
+        cancel_token = CancelToken()
+    if run_log is None:
+        run_log = NullRunLog()
+    cancel_token.raise_if_cancelled()
+
+    def run(staging_paths, start):
+        decode_command = [flac_binary, '--silent', '--stdout', '--decode', input_file_path]
+        encode_commands = [profile.encode_command(tags, staging_path)
+                           for (profile, _, _), staging_path in zip(outputs, staging_paths)]
+
+        if len(outputs) == 1:
+            decoder, decoder_err, encoders = run_piped(decode_command, encode_commands[0], input_file_path, start,
+                                                       buffer_size, cancel_token, run_log)
+        else:
+            decoder, decoder_err, encoders = run_fanned_out(decode_command, encode_commands, input_file_path, start,
+                                                            buffer_size, cancel_token, run_log)
+        cancel_token.raise_if_cancelled()
+
+        # If an encoder fails flac may die of a broken pipe, so the encoders are the more interesting ones to report.
+        if decoder.returncode != 0 and all(encoder is not None and encoder.returncode == 0 for encoder, _ in encoders):
+            raise subprocess.CalledProcessError(decoder.returncode, decode_command, stderr=decoder_err)
+
+        errors = []
+        for (encoder, encoder_err), command in zip(encoders, encode_commands):
+            if encoder is None:
+                errors.append(encoder_err)  # couldn't be started, e.g. the program isn't installed
+            elif encoder.returncode != 0:
+                errors.append(subprocess.CalledProcessError(encoder.returncode, command, stderr=encoder_err))
+            elif decoder.returncode != 0:
+                errors.append(subprocess.CalledProcessError(decoder.returncode, decode_command, stderr=decoder_err))
+            else:
+                errors.append(None)
+        return errors
+
+    write_outputs(input_file_path, outputs, run, cancel_token, run_log, committed, replaceable)
+
+
+def write_outputs(input_file_path, outputs, run, cancel_token, run_log, committed=None, replaceable=()):
+    """ Stage, encode and commit the outputs of one input file.
+
+    run(staging paths, start time) runs the programs that write the staging paths and returns an exception (or None if
+    it succeeded) per output. The outputs that succeeded are renamed to their final paths, then the first error is
+    raised. Whatever is left of the staging files is removed.
+    """
+    staging_paths = [staging_path_for(output_file_path, staging_dir) for _, output_file_path, staging_dir in outputs]
+    try:
+        start = time.perf_counter()
+        errors = run(staging_paths, start)
+        cancel_token.raise_if_cancelled()
+
+        first_error = None
+        for (profile, output_file_path, _), staging_path, error in zip(outputs, staging_paths, errors):
+            if error is not None:
+                first_error = first_error or error
+                continue
+            if run_log.enabled:
+                run_log.record(input_file_path, 'encode', time.perf_counter() - start, os.path.getsize(staging_path))
+            with run_log.stage(input_file_path, 'commit'):
+                commit_file(staging_path, output_file_path, output_file_path in replaceable)
+            if committed is not None:
+                committed(profile, output_file_path)
+        if first_error is not None:
+            raise first_error
+    finally:
+        for staging_path in staging_paths:
+            try:
+                os.remove(staging_path)
+            except OSError:
+                pass
+
+
+def run_piped(decode_command, encode_command, input_file_path, start, buffer_size, cancel_token, run_log):
+    """ Run flac and one encoder connected by a pipe.
+
+    Returns (decoder, its error output, [(encoder, its error output)]) once both exited.
+    """
+    decoder = subprocess.Popen(with_priority(decode_command), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               start_new_session=True)
+    cancel_token.register(decoder)
+    try:
+        set_pipe_size(decoder.stdout.fileno(), buffer_size)
+        try:
+            encoder = subprocess.Popen(with_priority(encode_command), stdin=decoder.stdout, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.PIPE, start_new_session=True)
+        except OSError:
+            decoder.kill()
+            decoder.communicate()
+            raise
+        cancel_token.register(encoder)
+
+        # Only the encoder reads from the pipe now. Closing our end lets flac notice if the encoder dies early.
+        decoder.stdout.close()
+
+        # flac usually exits well before the encoder, wait for it separately to know when.
+        decoder_waiter = None
+        if run_log.enabled:
+            decoder_waiter = threading.Thread(target=record_exit, args=(decoder, start, run_log, input_file_path))
+            decoder_waiter.start()
+
+        try:
+            encoder_out, encoder_err = encoder.communicate()
+            decoder_err = decoder.stderr.read()
+            decoder.stderr.close()
+            decoder.wait()
+            if decoder_waiter is not None:
+                decoder_waiter.join()
+        finally:
+            cancel_token.unregister(encoder)
+    finally:
+        cancel_token.unregister(decoder)
+
+    return decoder, decoder_err, [(encoder, encoder_err)]
+
+
+def read_and_close(f):
+    f.seek(0)
+    data = f.read()
+    f.close()
+    return data
+
+
+def run_fanned_out(decode_command, encode_commands, input_file_path, start, buffer_size, cancel_token, run_log):
+    """ Run flac and several encoders, copy the output of flac to all of them, return like run_piped().
+
+    The error output goes into temporary files, so a process writing lots of it never blocks on a full pipe while this
+    thread is busy passing on the audio. An encoder that can't be started is returned as (None, the OSError), the
+    others are run anyway.
+    """
+    decoder_err = tempfile.TemporaryFile()
+    decoder = subprocess.Popen(with_priority(decode_command), stdout=subprocess.PIPE, stderr=decoder_err,
+                               start_new_session=True)
+    cancel_token.register(decoder)
+    encoders = []
+    started = []
+    try:
+        try:
+            set_pipe_size(decoder.stdout.fileno(), buffer_size)
+            for encode_command in encode_commands:
+                encoder_err = tempfile.TemporaryFile()
+                try:
+                    encoder = subprocess.Popen(with_priority(encode_command), stdin=subprocess.PIPE,
+                                               stdout=subprocess.DEVNULL, stderr=encoder_err, start_new_session=True)
+                except OSError as e:
+                    encoder_err.close()
+                    encoders.append((None, e))
+                    continue
+                encoders.append((encoder, encoder_err))
+                started.append(encoder)
+                cancel_token.register(encoder)
+                set_pipe_size(encoder.stdin.fileno(), buffer_size)
+
+            # An encoder that exited early (failed) is dropped, the others get the rest of the audio.
+            receiving = [encoder.stdin for encoder in started]
+            while receiving:
+                chunk = decoder.stdout.read(fan_out_chunk_size)
+                if not chunk:
+                    break
+                for encoder_stdin in list(receiving):
+                    try:
+                        encoder_stdin.write(chunk)
+                    except BrokenPipeError:
+                        receiving.remove(encoder_stdin)
+        except BaseException:
+            decoder.kill()
+            for encoder in started:
+                encoder.kill()
+            raise
+        finally:
+            for encoder in started:
+                try:
+                    encoder.stdin.close()
+                except BrokenPipeError:
+                    pass
+            # Unblocks flac if all encoders are gone. Killed processes are waited for too, so none is left behind.
+            decoder.stdout.close()
+            decoder.wait()
+            for encoder in started:
+                encoder.wait()
+        if run_log.enabled:
+            run_log.record(input_file_path, 'decode', time.perf_counter() - start, os.path.getsize(input_file_path))
+    finally:
+        for encoder in started:
+            cancel_token.unregister(encoder)
+        cancel_token.unregister(decoder)
+
+    return (decoder, read_and_close(decoder_err),
+            [(encoder, read_and_close(encoder_err) if encoder is not None else encoder_err)
+             for encoder, encoder_err in encoders])
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+
+import flacmeta
+from progress import format_duration
+import scanner
+
+# What a batch run is going to do with every file, in the order they are listed in the plan.
+PLAN_TRANSCODE = 'transcode'
+PLAN_COPY = 'copy'
+PLAN_COVER = 'cover'
+PLAN_UNCHANGED = 'unchanged'  # transcoded or copied on an earlier run, the index says it didn't change since
+PLAN_RESUMED = 'resumed'  # done by the interrupted run that is being resumed
+PLAN_SKIP = 'skip'
+plan_actions = [PLAN_TRANSCODE, PLAN_COPY, PLAN_COVER, PLAN_UNCHANGED, PLAN_RESUMED, PLAN_SKIP]
+
+# Rough speeds for the time estimate: seconds of audio encoded per second by one worker (lame -V0 on one core of a
+# current machine), and bytes per second copied.
+estimated_encode_speed = 25.0
+estimated_copy_rate = 100 * 1024 * 1024
+
+
+def format_size(size):
+    if size < 1024:
+        return '%i B' % size
+    for unit in ('KB', 'MB', 'GB', 'TB'):
+        size /= 1024
+        if size < 1024 or unit == 'TB':
+            return '%.1f %s' % (size, unit)
+
+
+class PlanTotals(object):
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.audio_seconds = 0.0
+        # Audio seconds times the number of profiles the audio is encoded for.
+        self.encoded_seconds = 0.0
+
+
+class Plan(object):
+    """ Everything a batch run over one or more roots would do, built before anything is written.
+
+    albums is a list of (album folder, list of scanner.WorkItem still to do), totals the number of files, bytes and
+    seconds of audio per plan action.
+    """
+
+    def __init__(self):
+        self.albums = []
+        self.totals = {action: PlanTotals() for action in plan_actions}
+
+    def add(self, action, path, audio_seconds=0.0, profiles=1):
+        totals = self.totals[action]
+        totals.files += 1
+        totals.audio_seconds += audio_seconds
+        totals.encoded_seconds += audio_seconds * profiles
+        try:
+            totals.bytes += os.path.getsize(path)
+        except OSError:
+            pass
+
+    def estimated_seconds(self, action, workers, encode_speed=estimated_encode_speed):
+        """ Estimated wall time of one plan action, zero for the actions that don't write anything. """
+        totals = self.totals[action]
+        if action == PLAN_TRANSCODE:
+            return totals.encoded_seconds / (encode_speed * workers)
+        if action in (PLAN_COPY, PLAN_COVER):
+            return totals.bytes / estimated_copy_rate
+        return 0.0
+
+    def format(self, workers, encode_speed=estimated_encode_speed):
+        lines = ['%i albums' % len(self.albums),
+                 '%-10s %8s %12s %10s %10s' % ('action', 'files', 'size', 'audio', 'estimate')]
+        # Encoding and copying run at the same time, the longer of the two is the estimate of the whole run.
+        total_seconds = 0.0
+        for action in plan_actions:
+            totals = self.totals[action]
+            seconds = self.estimated_seconds(action, workers, encode_speed)
+            total_seconds = max(total_seconds, seconds)
+            audio = format_duration(totals.audio_seconds) if totals.audio_seconds else ''
+            estimate = format_duration(seconds) if seconds else ''
+            size = format_size(totals.bytes)
+            lines.append('%-10s %8i %12s %10s %10s' % (action, totals.files, size, audio, estimate))
+        lines.append('Estimated time with %i workers: %s' % (workers, format_duration(total_seconds)))
+        return '\n'.join(lines)
+
+
+def make_plan(roots, index, profiles, done=None):
+    """ Find all albums below roots and decide what to do with every file.
+
+    :param roots: list of str, album folders or whole libraries
+    :param index: TranscodeIndex
+    :param profiles: list of OutputProfile
+    :param done: set of str or None, the files done by the run that is being resumed
+    :return: Plan
+    """
+    plan = Plan()
+    seen = set()
+
+    for root in roots:
+        for album_dir, items in scanner.find_albums(os.path.abspath(root)):
+            # Overlapping roots (a library and an album inside it) list the same album twice.
+            if album_dir in seen:
+                continue
+            seen.add(album_dir)
+
+            todo = []
+            for item in items:
+                if done is not None and item.path in done:
+                    plan.add(PLAN_RESUMED, item.path)
+                elif item.action == scanner.ACTION_TRANSCODE:
+                    missing = [profile for profile in profiles if not index.is_current(item.path, profile.settings)]
+                    if not missing:
+                        plan.add(PLAN_UNCHANGED, item.path)
+                    else:
+                        # A file that can't be read is planned with no audio, the run reports it as failed.
+                        plan.add(PLAN_TRANSCODE, item.path, flacmeta.read_duration(item.path), len(missing))
+                        todo.append(item)
+                elif item.action == scanner.ACTION_COPY:
+                    if index.is_current(item.path, 'copy'):
+                        plan.add(PLAN_UNCHANGED, item.path)
+                    else:
+                        plan.add(PLAN_COPY, item.path)
+                        todo.append(item)
+                elif item.action == scanner.ACTION_COVER:
+                    plan.add(PLAN_COVER, item.path)
+                    todo.append(item)
+                else:
+                    plan.add(PLAN_SKIP, item.path)
+
+            if todo:
+                plan.albums.append((album_dir, todo))
+
+    return plan
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import itertools
+import os
+import queue
+import threading
+
+
+class Job(object):
+    def __init__(self, function, args, kwargs, cost=0.0):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.cost = cost
+
+        self.result = None
+        self.error = None
+        self.cancelled = False
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+
+
+class TranscodePool(object):
+    """ A fixed number of worker threads that run transcode jobs concurrently.
+
+    The actual work (decoding and encoding) happens in the flac/lame child processes, so a thread per job is enough to
+    keep all cores busy. The threads only start the pipelines and wait for them to finish.
+
+    Finished jobs are handed back through completed(), so the thread that submitted them stays in charge of updating the
+    progress and of reacting to a cancel request.
+
+    Waiting jobs are started longest first (by their estimated cost, i.e. seconds of audio). Otherwise a long track that
+    happens to be found last would start last and keep one core busy long after all the others ran out of work. Jobs
+    with a higher priority start before all jobs with a lower one, regardless of their cost.
+    """
+
+    # Sorts after every job, so workers only shut down once the jobs submitted before are done.
+    shutdown_priority = (float('inf'),)
+    # Sorts before every job, so the next worker that becomes free retires instead of starting another job.
+    retire_priority = (float('-inf'),)
+
+    def __init__(self, workers=None, finished_jobs=None):
+        if not workers or workers < 1:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+
+        # Entries are (priority, submission order, job), the order keeps jobs of equal priority first in first out.
+        self.pending_jobs = queue.PriorityQueue()
+        # May be shared with another pool, so one thread can wait for the jobs of both.
+        self.finished_jobs = finished_jobs if finished_jobs is not None else queue.Queue()
+        self.order = itertools.count()
+
+        self.lock = threading.Lock()
+        self.threads = []
+        for _ in range(self.workers):
+            self.start_worker()
+
+    def start_worker(self):
+        thread = threading.Thread(target=self.work)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def work(self):
+        while True:
+            priority, order, job = self.pending_jobs.get()
+            if job is None:  # shutdown() or resize() was called
+                if priority == self.retire_priority:
+                    with self.lock:
+                        self.threads.remove(threading.current_thread())
+                return
+            if not job.cancelled:
+                job.run()
+            self.finished_jobs.put(job)
+
+    def resize(self, workers):
+        """ Change the number of workers while jobs are running.
+
+        New workers start right away. Surplus workers finish the job they are running and stop, without starting another
+        one, so running jobs are never interrupted.
+        """
+        workers = max(workers, 1)
+        with self.lock:
+            for _ in range(workers - self.workers):
+                self.start_worker()
+            for _ in range(self.workers - workers):
+                self.pending_jobs.put((self.retire_priority, next(self.order), None))
+            self.workers = workers
+
+    def submit(self, function, *args, cost=0.0, priority=0, **kwargs):
+        job = Job(function, args, kwargs, cost)
+        self.pending_jobs.put(((-priority, -cost), next(self.order), job))
+        return job
+
+    def pending_count(self):
+        """ Number of jobs waiting for a worker (approximately, other threads may take or add jobs meanwhile). """
+        return self.pending_jobs.qsize()
+
+    def completed(self, timeout=None):
+        """ Return the next finished (or cancelled) job, or None if none finished within timeout seconds. """
+        try:
+            return self.finished_jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            threads = list(self.threads)
+        for _ in threads:
+            self.pending_jobs.put((self.shutdown_priority, next(self.order), None))
+        if wait:
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import shlex
+
+from pipeline import find_binary
+
+lame_binary = find_binary('lame')
+ffmpeg_binary = find_binary('ffmpeg')
+
+# File extension written by each encoder, and the container ffmpeg writes it in.
+encoder_extensions = {'lame': '.mp3', 'aac': '.m4a'}
+encoder_formats = {'lame': 'mp3', 'aac': 'ipod'}
+
+# lame options that only matter to lame's own tag writing, ffmpeg writes ID3v2 tags anyway.
+lame_tag_writing_options = {'--add-id3v2', '--pad-id3v2', '--ignore-tag-errors', '--id3v2-only'}
+
+
+def lame_tag_options(tags):
+    return ['--ta', tags['ARTIST'], '--tt', tags['TITLE'], '--tn', tags['TRACKNUMBER'], '--tl', tags['ALBUM'],
+            '--tg', tags['GENRE'], '--ty', tags['DATE'], '--tv', 'TPOS=%s' % tags['DISCNUMBER']]
+
+
+def ffmpeg_tag_options(tags):
+    options = []
+    for name, key in (('artist', 'ARTIST'), ('title', 'TITLE'), ('track', 'TRACKNUMBER'), ('album', 'ALBUM'),
+                      ('genre', 'GENRE'), ('date', 'DATE'), ('disc', 'DISCNUMBER')):
+        options += ['-metadata', '%s=%s' % (name, tags[key])]
+    return options
+
+
+def output_name(input_file_path, album_dir=None):
+    """ Name of the output of input_file_path in the flat output folder, without the extension.
+
+    Files in subfolders of album_dir (disc folders) are prefixed with the subfolders, "CD2 - 01 - Intro", so the tracks
+    of different discs don't overwrite each other.
+    """
+    name = os.path.splitext(os.path.basename(input_file_path))[0]
+    if album_dir is None:
+        return name
+    sub_dir = os.path.relpath(os.path.dirname(input_file_path), album_dir)
+    if sub_dir == os.curdir or sub_dir.startswith(os.pardir):
+        return name
+    return ' - '.join(sub_dir.split(os.sep) + [name])
+
+
+class OutputProfile(object):
+    """ One encoding of the library, e.g. V0 mp3 for iTunes and 256k AAC for the phones, written to its own folder.
+
+    encoder is 'lame' (options are lame options, e.g. '-V0') or 'aac' (ffmpeg's AAC encoder, options are ffmpeg output
+    options, e.g. '-b:a 256k').
+
+    backend is the name of the backend that runs the encoder (see backends.py), None picks the faster one by timing the
+    first files of a run.
+
+    :param name: str, shown in messages
+    :param encoder: str, 'lame' or 'aac'
+    :param options: str
+    :param output_dir: str
+    :param backend: str or None
+    """
+
+    def __init__(self, name, encoder, options, output_dir, backend=None):
+        if encoder not in encoder_extensions:
+            raise ValueError('Unknown encoder "%s" of profile "%s"' % (encoder, name))
+        self.name = name
+        self.encoder = encoder
+        self.options = options
+        self.output_dir = output_dir
+        self.backend = backend
+
+    @property
+    def settings(self):
+        """ What the index knows files transcoded with this profile by, other settings mean transcoding again. """
+        return '%s %s' % (self.encoder, self.options)
+
+    def output_path(self, input_file_path, album_dir=None):
+        return os.path.join(self.output_dir, output_name(input_file_path, album_dir) + encoder_extensions[self.encoder])
+
+    def encode_command(self, tags, output_file_path):
+        """ Command that reads the decoded audio as WAV from stdin and writes output_file_path. """
+        if self.encoder == 'lame':
+            return [lame_binary] + shlex.split(self.options) + lame_tag_options(tags) + ['-', output_file_path]
+        # The output is a temporary name without the .m4a extension, so the container is given explicitly.
+        return ([ffmpeg_binary, '-nostdin', '-loglevel', 'error', '-f', 'wav', '-i', '-', '-vn', '-c:a', 'aac'] +
+                shlex.split(self.options) + ffmpeg_tag_options(tags) + ['-f', 'ipod', '-y', output_file_path])
+
+    def ffmpeg_codec_options(self):
+        """ The options as options of ffmpeg, ValueError if lame options can't be translated.
+
+        Only the lame options that control the quality are translated: -V, -b and -q (plus the tag options, which
+        ffmpeg doesn't need).
+        """
+        if self.encoder == 'aac':
+            return ['-c:a', 'aac'] + shlex.split(self.options)
+
+        codec_options = ['-c:a', 'libmp3lame', '-id3v2_version', '3']
+        options = shlex.split(self.options)
+        while options:
+            option = options.pop(0)
+            if option in lame_tag_writing_options:
+                continue
+            if option in ('-V', '-b', '-q') and options:
+                value = options.pop(0)
+            elif option[:2] in ('-V', '-b', '-q') and len(option) > 2:
+                option, value = option[:2], option[2:]
+            else:
+                raise ValueError('lame option %s of profile "%s" has no ffmpeg equivalent' % (option, self.name))
+            codec_options += {'-V': ['-q:a', value], '-b': ['-b:a', value + 'k'],
+                              '-q': ['-compression_level', value]}[option]
+        return codec_options
+
+    def ffmpeg_output_options(self, tags, output_file_path):
+        """ Options of one output of an ffmpeg process that decodes the FLAC file itself. """
+        return (['-map', '0:a', '-map_metadata', '-1'] + self.ffmpeg_codec_options() + ffmpeg_tag_options(tags) +
+                ['-f', encoder_formats[self.encoder], '-y', output_file_path])
+
+    def __repr__(self):
+        return 'OutputProfile(%r, %r, %r, %r, %r)' % (self.name, self.encoder, self.options, self.output_dir,
+                                                      self.backend)
+
+
+def output_profiles(output_dir, lame_options, extra_profiles=None, backend=None):
+    """ The mp3 profile of the lame options followed by the additional profiles of the settings. """
+    return [OutputProfile('mp3', 'lame', lame_options, output_dir, backend)] + list(extra_profiles or [])
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '%i:%02i:%02i' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    return '%i:%02i' % (seconds // 60, seconds % 60)
+
+
+class Progress(object):
+    """ Progress of a run, weighted by the length of the audio of each file instead of counting files.
+
+    A 20 minute track counts ten times as much as a 2 minute one. The speed is measured in seconds of audio transcoded
+    per second of wall clock time, which also gives an estimate of the remaining time.
+
+    add() is called for every file handed to the workers, finish() once it is done (or failed, or was cancelled). As
+    files are added while the folder is still being scanned, the total may grow during the run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+
+        self.files_total = 0
+        self.files_finished = 0
+        self.seconds_total = 0.0
+        self.seconds_finished = 0.0
+
+    def add(self, seconds):
+        with self.lock:
+            self.files_total += 1
+            self.seconds_total += seconds
+
+    def finish(self, seconds):
+        with self.lock:
+            self.files_finished += 1
+            self.seconds_finished += seconds
+
+    @property
+    def fraction(self):
+        if not self.seconds_total:
+            return 1.0 if self.files_finished >= self.files_total else 0.0
+        return min(self.seconds_finished / self.seconds_total, 1.0)
+
+    @property
+    def speed(self):
+        """ Seconds of audio transcoded per second. """
+        elapsed = time.monotonic() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.seconds_finished / elapsed
+
+    @property
+    def eta(self):
+        """ Estimated seconds until all files added so far are done, None as long as nothing finished. """
+        speed = self.speed
+        if not speed:
+            return None
+        return max(self.seconds_total - self.seconds_finished, 0.0) / speed
+
+    def __str__(self):
+        status = '%.2f%% (%i/%i files)' % (self.fraction * 100, self.files_finished, self.files_total)
+        if self.eta is not None:
+            status += ', %.1fx, %s left' % (self.speed, format_duration(self.eta))
+        return status
@@ -0,0 +1,462 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import queue
+import select
+import shutil
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+
+import backends
+from cancel import CancelToken, Cancelled
+import pipeline
+from profiles import OutputProfile
+from runlog import NullRunLog
+
+# Encoding on other machines. An encode worker runs on every machine that should help out ...
+#     python3 remote.py --listen 0.0.0.0:7878 --slots 8
+# ... and the machine that transcodes (the coordinator) lists them in the settings ("remote_workers": ["host:7878"]) and
+# uses the backend 'remote'. The coordinator still scans, reads the tags, and commits every file into the output folder
+# itself, the workers only see a stream of FLAC bytes and send back the encoded bytes.
+#
+# Protocol, over TCP: every message is a line of JSON, optionally followed by raw bytes whose length the message states.
+#     worker -> coordinator, on connect    {"type": "hello", "version": 1, "slots": 8}
+#     coordinator -> worker                {"type": "encode", "size": <FLAC bytes>, "tags": {...},
+#                                           "outputs": [{"name": ..., "encoder": ..., "options": ...}, ...]}
+#                                          followed by the FLAC file
+#     worker -> coordinator                {"type": "result", "outputs": [{"size": <bytes>} or {"error": ...}, ...]}
+#                                          followed by the files of the outputs that succeeded, in order
+# Each connection runs one job at a time, the coordinator opens as many connections to a worker as it has slots. All
+# connections take their next job from one queue, so a fast worker simply takes more jobs than a slow one. A job whose
+# worker disappears (connection lost or no answer for job_timeout seconds) goes back into the queue for any worker.
+# Closing the connection cancels the job on the worker.
+#
+# There is no authentication: only run workers on a trusted network, they run lame/ffmpeg with the options they get.
+
+protocol_version = 1
+default_port = 7878
+
+max_message_size = 1024 * 1024
+copy_chunk_size = 1024 * 1024
+
+
+class RemoteEncodeError(Exception):
+    """ The worker ran the job, but it failed. Not retried, another worker would fail the same way. """
+    pass
+
+
+class WorkerLost(Exception):
+    pass
+
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def receive_message(reader):
+    line = reader.readline(max_message_size)
+    if not line.endswith(b'\n'):
+        raise ConnectionError('Connection closed')
+    return json.loads(line.decode('utf-8'))
+
+
+def send_file(sock, path):
+    with open(path, 'rb') as f:
+        sock.sendfile(f)
+
+
+def receive_file(reader, path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            chunk = reader.read(min(copy_chunk_size, remaining))
+            if not chunk:
+                raise ConnectionError('Connection closed after %i of %i bytes' % (size - remaining, size))
+            f.write(chunk)
+            remaining -= len(chunk)
+
+
+def parse_address(address):
+    """ 'host:port' (or just 'host') as (host, port). """
+    host, _, port = address.rpartition(':')
+    if not host:
+        return address, default_port
+    if not port.isdigit():
+        raise ValueError('%s has no port number' % address)
+    return host, int(port)
+
+
+# Coordinator ----------------------------------------------------------------------------------------------------------
+
+
+class RemoteJob(object):
+    def __init__(self, input_file_path, profiles, tags, staging_paths):
+        self.input_file_path = input_file_path
+        self.profiles = profiles
+        self.tags = tags
+        self.staging_paths = staging_paths
+        self.attempts = 0
+        self.cancelled = False
+        # Socket of the worker running the job, shut down to abort it.
+        self.connection = None
+        # One exception or None per output once the job is done, or failure if it couldn't be run at all.
+        self.errors = None
+        self.failure = None
+        self.done = threading.Event()
+
+    def finish(self, errors=None, failure=None):
+        self.errors = errors
+        self.failure = failure
+        self.done.set()
+
+    def cancel(self):
+        self.cancelled = True
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class RemoteBackend(object):
+    """ Runs the encoders of a file on the encode workers, see the comment at the top of the module. """
+
+    name = 'remote'
+    # Never picked by the BackendSelector: the point of remote workers is more capacity, not a faster single file.
+    automatic = False
+
+    # Tries of a job on workers that got lost while running it.
+    max_attempts = 3
+    connect_timeout = 5.0
+    # A worker that doesn't send anything for this long while it has a job counts as lost.
+    job_timeout = 600.0
+    # Jobs fail if no worker could be reached for this long.
+    unreachable_timeout = 60.0
+    max_reconnect_delay = 30.0
+
+    def __init__(self):
+        self.addresses = []
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = False
+        # Address -> slots, for the workers that answered at least once.
+        self.slots = {}
+        # Called with the total number of slots whenever another worker answered for the first time.
+        self.slot_listeners = []
+        self.connections = 0
+        self.last_connected = time.monotonic()
+
+    def configure(self, addresses):
+        """ Set the workers (list of 'host:port'), only before the first job. """
+        with self.lock:
+            if not self.started:
+                self.addresses = list(addresses)
+
+    def is_available(self):
+        return bool(self.addresses)
+
+    def supports(self, profile):
+        return True
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            self.last_connected = time.monotonic()
+            for address in self.addresses:
+                thread = threading.Thread(target=self.run_worker, args=(address,))
+                thread.daemon = True
+                thread.start()
+
+    def add_slot_listener(self, listener):
+        """ Call listener(total slots) now if workers answered already, and whenever another worker answers. """
+        with self.lock:
+            self.slot_listeners.append(listener)
+            total = sum(self.slots.values())
+        if total:
+            listener(total)
+
+    def remove_slot_listener(self, listener):
+        with self.lock:
+            if listener in self.slot_listeners:
+                self.slot_listeners.remove(listener)
+
+    def connect(self, address):
+        sock = socket.create_connection(parse_address(address), timeout=self.connect_timeout)
+        try:
+            reader = sock.makefile('rb')
+            hello = receive_message(reader)
+            if hello.get('type') != 'hello' or hello.get('version') != protocol_version:
+                raise ConnectionError('%s is no encode worker of this version' % address)
+        except BaseException:
+            sock.close()
+            raise
+        sock.settimeout(self.job_timeout)
+        with self.lock:
+            self.connections += 1
+            self.last_connected = time.monotonic()
+        return sock, reader, int(hello['slots'])
+
+    def disconnect(self, sock):
+        sock.close()
+        with self.lock:
+            self.connections -= 1
+            self.last_connected = time.monotonic()
+
+    def run_worker(self, address):
+        """ Open the first connection to a worker, then one more for every further slot it has. """
+        delay = 1.0
+        while True:
+            try:
+                sock, reader, slots = self.connect(address)
+                break
+            except (OSError, ValueError):
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+        with self.lock:
+            self.slots[address] = slots
+            total = sum(self.slots.values())
+            listeners = list(self.slot_listeners)
+        for listener in listeners:
+            listener(total)
+        for _ in range(slots - 1):
+            thread = threading.Thread(target=self.run_slot, args=(address,))
+            thread.daemon = True
+            thread.start()
+        self.run_slot(address, (sock, reader))
+
+    def run_slot(self, address, connection=None):
+        delay = 1.0
+        while True:
+            if connection is None:
+                try:
+                    connection = self.connect(address)[:2]
+                    delay = 1.0
+                except (OSError, ValueError):
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_reconnect_delay)
+                    continue
+
+            job = self.jobs.get()
+            if job.cancelled:
+                job.finish()
+                continue
+
+            sock, reader = connection
+            try:
+                self.run_job(address, job, sock, reader)
+            except (OSError, ValueError) as e:
+                # Lost the worker (or it sent garbage). The job goes back into the queue for any worker.
+                self.disconnect(sock)
+                connection = None
+                job.connection = None
+                job.attempts += 1
+                if job.cancelled:
+                    job.finish()
+                elif job.attempts >= self.max_attempts:
+                    job.finish(failure=WorkerLost('Lost the worker %i times, last %s: %s' % (job.attempts, address, e)))
+                else:
+                    self.jobs.put(job)
+
+    def run_job(self, address, job, sock, reader):
+        job.connection = sock
+        if job.cancelled:  # cancelled before the connection was known
+            raise ConnectionError('Cancelled')
+        send_message(sock, {'type': 'encode', 'size': os.path.getsize(job.input_file_path), 'tags': job.tags,
+                            'outputs': [{'name': profile.name, 'encoder': profile.encoder, 'options': profile.options}
+                                        for profile in job.profiles]})
+        send_file(sock, job.input_file_path)
+
+        response = receive_message(reader)
+        if response.get('type') != 'result' or len(response.get('outputs', [])) != len(job.profiles):
+            raise ValueError('Unexpected answer %r' % response)
+        errors = []
+        for result, staging_path in zip(response['outputs'], job.staging_paths):
+            if 'error' in result:
+                errors.append(RemoteEncodeError('%s: %s' % (address, result['error'])))
+            else:
+                receive_file(reader, staging_path, int(result['size']))
+                errors.append(None)
+        job.connection = None
+        job.finish(errors)
+
+    def unreachable(self):
+        with self.lock:
+            return self.connections == 0 and time.monotonic() - self.last_connected > self.unreachable_timeout
+
+    def transcode(self, input_file_path, outputs, tags, cancel_token=None, run_log=None, committed=None,
+                  replaceable=()):
+        """ Encode all outputs on one of the workers, like pipeline.transcode() does locally. """
+        if cancel_token is None:
+            cancel_token = CancelToken()
+        if run_log is None:
+            run_log = NullRunLog()
+        cancel_token.raise_if_cancelled()
+        if not self.addresses:
+            raise WorkerLost('No remote workers configured')
+        self.start()
+
+        def run(staging_paths, start):
+            job = RemoteJob(input_file_path, [profile for profile, _, _ in outputs], tags, staging_paths)
+            self.jobs.put(job)
+            while not job.done.wait(0.2):
+                if cancel_token.cancelled:
+                    job.cancel()
+                    # Don't return before the worker connection stopped writing into the staging files.
+                    job.done.wait(5.0)
+                    break
+                if self.unreachable():
+                    job.cancel()
+                    raise WorkerLost('None of the workers %s could be reached' % ', '.join(self.addresses))
+            cancel_token.raise_if_cancelled()
+            if job.failure is not None:
+                raise job.failure
+            return job.errors
+
+        pipeline.write_outputs(input_file_path, outputs, run, cancel_token, run_log, committed, replaceable)
+
+
+backends.backends[RemoteBackend.name] = RemoteBackend()
+
+
+# Worker ---------------------------------------------------------------------------------------------------------------
+
+
+def describe_error(error):
+    if isinstance(error, subprocess.CalledProcessError) and error.stderr:
+        return '%s %s' % (error, error.stderr.decode('utf-8', 'replace').strip()[-500:])
+    return str(error)
+
+
+def watch_connection(sock, cancel_token, stop):
+    """ Cancel the job if the coordinator closes the connection while the job runs. """
+    while not stop.is_set():
+        readable, _, _ = select.select([sock], [], [], 0.2)
+        if readable:
+            try:
+                if not sock.recv(1, socket.MSG_PEEK):
+                    cancel_token.cancel()
+            except OSError:
+                cancel_token.cancel()
+            return
+
+
+class EncodeWorker(object):
+    """ Runs the jobs of coordinators with a local backend, at most slots of them at the same time. """
+
+    def __init__(self, slots, backend_name='pipe', staging_dir=None):
+        self.slots = slots
+        self.slot = threading.Semaphore(slots)
+        self.backend = backends.backends[backend_name]
+        self.staging_dir = staging_dir
+
+    def encode(self, request, reader, sock):
+        """ Run one job, False if the connection has to be closed. """
+        job_dir = tempfile.mkdtemp(prefix='transcode_job_', dir=self.staging_dir)
+        try:
+            input_path = os.path.join(job_dir, 'input.flac')
+            receive_file(reader, input_path, int(request['size']))
+
+            outputs = []
+            for index, output in enumerate(request['outputs']):
+                profile = OutputProfile(output['name'], output['encoder'], output['options'], job_dir)
+                outputs.append((profile, os.path.join(job_dir, 'output%i' % index), None))
+
+            cancel_token = CancelToken()
+            stop_watching = threading.Event()
+            watcher = threading.Thread(target=watch_connection, args=(sock, cancel_token, stop_watching))
+            watcher.start()
+            error = None
+            try:
+                self.backend.transcode(input_path, outputs, request['tags'], cancel_token=cancel_token)
+            except Cancelled:
+                return False
+            except Exception as e:
+                error = e
+            finally:
+                stop_watching.set()
+                watcher.join()
+
+            results = []
+            for _, output_path, _ in outputs:
+                if os.path.exists(output_path):
+                    results.append({'size': os.path.getsize(output_path)})
+                else:
+                    results.append({'error': describe_error(error) if error is not None else 'No output'})
+            send_message(sock, {'type': 'result', 'outputs': results})
+            for (_, output_path, _), result in zip(outputs, results):
+                if 'size' in result:
+                    send_file(sock, output_path)
+            return True
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+class EncodeWorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        worker = self.server.worker
+        send_message(self.connection, {'type': 'hello', 'version': protocol_version, 'slots': worker.slots})
+        while True:
+            try:
+                request = receive_message(self.rfile)
+            except (OSError, ValueError):
+                return
+            if request.get('type') != 'encode':
+                return
+            with worker.slot:
+                try:
+                    if not worker.encode(request, self.rfile, self.connection):
+                        return
+                except (OSError, ValueError, KeyError) as e:
+                    print('Dropping the connection of %s:%i: %s' % (self.client_address[0], self.client_address[1],
+                                                                     e))
+                    return
+
+
+class EncodeWorkerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, worker):
+        self.worker = worker
+        super().__init__(address, EncodeWorkerHandler)
+
+
+def process_cl_args():
+    parser = argparse.ArgumentParser(description='Encode files for transcode coordinators on other machines.')
+    parser.add_argument('--listen', default='127.0.0.1:%i' % default_port,
+                        help='address to listen on (default: 127.0.0.1:%i, 0.0.0.0:%i for all interfaces, port 0 '
+                             'for any free port)' % (default_port, default_port))
+    parser.add_argument('--slots', type=int, default=os.cpu_count() or 1,
+                        help='files encoded at the same time (default: one per core)')
+    parser.add_argument('--backend', default='pipe', choices=['pipe', 'ffmpeg'], help='how files are encoded here')
+    parser.add_argument('--staging-dir', default=None, help='folder for the files of running jobs (e.g. a tmpfs)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from settings import load_settings
+
+    args = process_cl_args()
+    # Programs, nice/ionice and the pipe size of this machine.
+    load_settings().apply()
+
+    server = EncodeWorkerServer(parse_address(args.listen), EncodeWorker(args.slots, args.backend, args.staging_dir))
+    print('Listening on %s:%i with %i slots' % (server.server_address[0], server.server_address[1], args.slots),
+          flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
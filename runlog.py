@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import contextlib
+import cProfile
+import json
+import math
+import threading
+import time
+
+# Stages recorded per file:
+#     tags       reading the tags (native reader or metaflac)
+#     decode     flac, from start until it exited
+#     encode     lame, from start until it exited (runs at the same time as decode, so the two overlap)
+#     commit     renaming the finished mp3 into the import folder
+#     copy       copying a passthrough mp3/m4a
+#     cover      writing the cover art of an album (per album folder, not per file)
+#     index      looking up / recording the file in the transcode index
+
+
+def percentile(sorted_values, fraction):
+    # Nearest rank, good enough for a summary and needs no interpolation between samples.
+    if not sorted_values:
+        return 0.0
+    rank = max(int(math.ceil(fraction * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+class RunLog(object):
+    """ Opt-in instrumentation of a run: per file, per stage durations and bytes, written as JSON lines.
+
+    Every record is a line of its own, so the log can be followed (tail -f) or parsed while the run is still going.
+    close() appends an end of run summary: totals, p50/p95 per stage and the slowest files.
+
+    If profile_path is given the thread that calls start_profile() (the dispatcher of the scheduler, which scans the
+    folders and hands the files to the workers) runs under cProfile and the statistics are dumped to profile_path on
+    close(), e.g. for
+        python3 -m pstats profile.out
+    The flac/lame processes aren't profiled, their time shows up in the decode/encode stages.
+    """
+
+    enabled = True
+    slowest_files_count = 10
+
+    def __init__(self, log_path, profile_path=None):
+        self.lock = threading.Lock()
+        self.log_file = open(log_path, 'a')
+        self.start_time = time.time()
+        self.records = []
+
+        self.profile_path = profile_path
+        self.profiler = None
+
+        self.write({'event': 'start'})
+
+    def start_profile(self):
+        if self.profile_path and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop_profile(self):
+        # Has to be called from the same thread as start_profile().
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def write(self, record):
+        record['time'] = time.time()
+        with self.lock:
+            self.log_file.write(json.dumps(record) + '\n')
+            self.log_file.flush()
+
+    def record(self, file_path, stage, seconds, bytes_processed=0):
+        with self.lock:
+            self.records.append((file_path, stage, seconds, bytes_processed))
+        self.write({'event': 'stage', 'file': file_path, 'stage': stage, 'seconds': seconds,
+                    'bytes': bytes_processed})
+
+    @contextlib.contextmanager
+    def stage(self, file_path, stage, bytes_processed=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(file_path, stage, time.perf_counter() - start, bytes_processed)
+
+    def summary(self):
+        with self.lock:
+            records = list(self.records)
+
+        stages = {}
+        file_seconds = {}
+        for file_path, stage, seconds, bytes_processed in records:
+            totals = stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'durations': []})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += bytes_processed
+            totals['durations'].append(seconds)
+            if stage != 'decode':  # happens during encode, counting it too would count the same time twice
+                file_seconds[file_path] = file_seconds.get(file_path, 0.0) + seconds
+
+        for totals in stages.values():
+            durations = sorted(totals.pop('durations'))
+            totals['p50'] = percentile(durations, 0.5)
+            totals['p95'] = percentile(durations, 0.95)
+
+        slowest_files = sorted(file_seconds.items(), key=lambda item: item[1], reverse=True)
+        return {
+            'wall_seconds': time.time() - self.start_time,
+            'files': len(file_seconds),
+            'stages': stages,
+            'slowest_files': [{'file': file_path, 'seconds': seconds}
+                              for file_path, seconds in slowest_files[:self.slowest_files_count]],
+        }
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_path)
+
+        summary = self.summary()
+        self.write(dict(summary, event='summary'))
+        self.log_file.close()
+        return summary
+
+
+class NullRunLog(object):
+    """ Stand-in when instrumentation is off, so callers don't need to check. """
+
+    enabled = False
+
+    def start_profile(self):
+        pass
+
+    def stop_profile(self):
+        pass
+
+    def write(self, record):
+        pass
+
+    def record(self, file_path, stage, seconds, bytes_processed=0):
+        pass
+
+    def stage(self, file_path, stage, bytes_processed=0):
+        return contextlib.nullcontext()
+
+    def close(self):
+        return None
+
+
+def format_summary(summary):
+    lines = ['%i files in %.1f s' % (summary['files'], summary['wall_seconds'])]
+    for stage, totals in sorted(summary['stages'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+        lines.append('  %-8s %5i x  total %8.2f s  p50 %7.3f s  p95 %7.3f s  %8.1f MB' %
+                     (stage, totals['count'], totals['seconds'], totals['p50'], totals['p95'],
+                      totals['bytes'] / 1000000))
+    if summary['slowest_files']:
+        lines.append('  slowest files:')
+        for slow_file in summary['slowest_files']:
+            lines.append('    %7.2f s  %s' % (slow_file['seconds'], slow_file['file']))
+    return '\n'.join(lines)
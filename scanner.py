@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import os
+import re
+
+ACTION_TRANSCODE = 'transcode'
+ACTION_COPY = 'copy'
+ACTION_COVER = 'cover'
+ACTION_SKIP = 'skip'
+
+WorkItem = namedtuple('WorkItem', ['action', 'path'])
+
+# Subfolders like these are parts of the album in their parent folder, not albums of their own.
+disc_folder_pattern = re.compile(r'^(cd|disc|disk)\s*\d+\b', re.IGNORECASE)
+
+# Cover art next to the audio files.
+cover_file_pattern = re.compile(r'^(folder|cover)\.(jpe?g|png|gif|webp)$', re.IGNORECASE)
+
+
+def classify(file_name):
+    if file_name.startswith('.'):
+        return ACTION_SKIP
+    elif cover_file_pattern.match(file_name):
+        return ACTION_COVER
+    elif file_name.endswith('.mp3') or file_name.endswith('.m4a'):
+        return ACTION_COPY
+    elif file_name.endswith('.flac'):
+        return ACTION_TRANSCODE
+    else:
+        return ACTION_SKIP
+
+
+def scan(input_dir):
+    """ Walk input_dir and all of its subdirectories (e.g. "CD1", "CD2") and yield a WorkItem for every file.
+
+    This is a generator, items are yielded as soon as they are found, so the caller can start transcoding the first
+    files while the rest of the tree is still being read. The files of a directory are yielded before descending into
+    its subdirectories, subdirectories are visited in alphabetical order. Hidden directories and directories that can't
+    be read are skipped.
+
+    :param input_dir: str
+    :return: generator of WorkItem
+    """
+    pending_dirs = [input_dir]
+
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        sub_dirs = []
+
+        try:
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith('.'):
+                            sub_dirs.append(entry.path)
+                    elif entry.is_file():
+                        yield WorkItem(classify(entry.name), entry.path)
+        except OSError:
+            continue
+
+        # Reversed, so the alphabetically first directory is popped next.
+        pending_dirs.extend(sorted(sub_dirs, reverse=True))
+
+
+def find_albums(root_dir):
+    """ Walk a whole library (or any folder below it) and yield (album folder, list of WorkItem) for every album.
+
+    An album is a folder that directly contains files to transcode or copy (or a cover), together with its disc
+    subfolders ("CD1", "Disc 2", ...). Folders with nothing of their own, e.g. the artist folders, only lead to the
+    albums below them. Albums are yielded in alphabetical order of their path.
+
+    :param root_dir: str
+    :return: generator of (str, list of WorkItem)
+    """
+    pending_dirs = [root_dir]
+
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        items = []
+        disc_dirs = []
+        sub_dirs = []
+
+        try:
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name.startswith('.'):
+                            continue
+                        if disc_folder_pattern.match(entry.name):
+                            disc_dirs.append(entry.path)
+                        else:
+                            sub_dirs.append(entry.path)
+                    elif entry.is_file():
+                        items.append(WorkItem(classify(entry.name), entry.path))
+        except OSError:
+            continue
+
+        if any(item.action != ACTION_SKIP for item in items) or disc_dirs:
+            items.sort(key=lambda item: item.path)
+            for disc_dir in sorted(disc_dirs):
+                items.extend(scan(disc_dir))
+            yield current_dir, items
+
+        # Reversed, so the alphabetically first directory is popped next.
+        pending_dirs.extend(sorted(sub_dirs, reverse=True))
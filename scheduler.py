@@ -0,0 +1,494 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import itertools
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+import backends
+from cancel import CancelToken, Cancelled
+import controller
+import copier
+from covers import AlbumCovers, write_covers
+import flacmeta
+from index import TranscodeIndex
+from pool import TranscodePool
+from profiles import output_name, output_profiles
+from progress import Progress
+from runlog import NullRunLog
+import scanner
+from tags import get_tags, TAG_NAMES
+
+
+class AlbumJob(object):
+    """ One dropped folder, with its own cancel token, progress and temporary directory.
+
+    listener(album, message) is called for every file that was handled (message is a line to show, e.g. 'Transcoded
+    "01 - Intro.flac", ...') and once more when the album is done (message is None). file_done(album, path, action) is
+    called for every file that was transcoded or copied successfully. Both are called from the threads of the
+    scheduler, so they have to be thread-safe (e.g. emit a Qt signal).
+
+    items are the files of the album (list of scanner.WorkItem), None scans input_dir and all of its subfolders.
+
+    errors lists (path, error message) of everything that failed, the album folder itself if it couldn't be read.
+    outputs are the output paths the album claimed, see TranscodeScheduler.claim_outputs(). A file may be handed to
+    the pool as several jobs (e.g. for local and remote profiles), pending_files counts its jobs that didn't finish yet.
+    """
+
+    def __init__(self, input_dir, priority=0, cancel_token=None, listener=None, items=None, file_done=None):
+        # Sanitize passed path
+        if input_dir.endswith('/'):
+            input_dir = input_dir[:-1]
+        self.input_dir = input_dir
+        self.name = os.path.basename(input_dir)
+        self.priority = priority
+        self.cancel_token = cancel_token if cancel_token is not None else CancelToken()
+        self.listener = listener
+        self.items = items
+        self.file_done = file_done
+        self.progress = Progress()
+
+        self.lock = threading.Lock()
+        self.jobs = []  # the files handed to the pool
+        self.pending_files = {}  # path -> number of its jobs that didn't finish yet
+        self.failed_files = set()  # paths of pending files with a failed (or cancelled) job
+        self.scanning = True
+        self.staging_dir = None
+        self.errors = []
+        self.outputs = []
+        self.finished = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_token.cancelled
+
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    def wait(self, timeout=None):
+        """ Wait until all files of the album are done (or cancelled), return False on timeout. """
+        return self.finished.wait(timeout)
+
+    def notify(self, message):
+        if self.listener is not None:
+            self.listener(self, message)
+
+
+class TranscodeScheduler(object):
+    """ Transcodes any number of albums with a single, bounded pool of workers.
+
+    Albums are queued by priority (higher first, albums of the same priority in the order they were submitted). One
+    dispatcher thread scans them one after the other, copies their passthrough files and hands their FLAC
+    files to the pool. It doesn't wait for an album to finish before it starts with the next one, so the tracks of all
+    queued albums interleave in the pool and the cores stay busy while the last long track of the previous album is
+    encoding. The pool starts tracks by album priority first and longest first within the same priority.
+
+    Every album has its own cancel token, progress and temporary directory (inside output_dir, so the finished files can
+    still be renamed into place atomically, or inside staging_dir, e.g. a tmpfs, from where they are copied). Cancelling
+    an album drops its files that didn't start yet and kills its running processes, the other albums go on undisturbed.
+
+    Cover art and passthrough files are copied by a separate, small pool (copy_workers), so copying from a slow share
+    doesn't hold up scanning and encoding, see copier.copy_file() for how they are copied. The cover art of an album is
+    written once its scan is done, from its cover files or embedded pictures, see covers.py.
+
+    Without a fixed number of workers the pool starts with one worker per core and a ConcurrencyController adjusts the
+    number while transcoding (Linux only, elsewhere it stays at one per core). Its decisions are passed on to the
+    listeners of the albums that are running.
+    """
+
+    def __init__(self, output_dir, cover_art_output_dir, lame_options, index_path, workers=None, run_log=None,
+                 copy_workers=4, allow_hardlinks=False, extra_profiles=None, backend=None, staging_dir=None):
+        self.output_dir = output_dir
+        self.staging_dir = staging_dir
+        self.cover_art_output_dir = cover_art_output_dir
+        # Every FLAC file is decoded once and encoded for all profiles at the same time. Files transcoded with
+        # different encoder settings are transcoded again, for the profiles whose settings changed.
+        self.profiles = output_profiles(output_dir, lame_options, extra_profiles, backend)
+        for profile in self.profiles:
+            if profile.backend is not None and profile.backend not in backends.backends:
+                raise ValueError('Unknown backend "%s" of profile "%s"' % (profile.backend, profile.name))
+
+        self.pool = TranscodePool(workers)
+        # Copying waits for the disks, not the CPU. Finished copies arrive in the same queue as finished transcodes.
+        self.copy_pool = TranscodePool(copy_workers, finished_jobs=self.pool.finished_jobs)
+        # Profiles encoded on remote workers have a pool of their own, with as many workers as the remote workers have
+        # slots. It starts with one per address and grows as the workers answer, without waiting for them here.
+        self.remote_pool = None
+        if any(profile.backend == 'remote' for profile in self.profiles):
+            remote_backend = backends.backends['remote']
+            self.remote_pool = TranscodePool(max(len(remote_backend.addresses), 1),
+                                             finished_jobs=self.pool.finished_jobs)
+            remote_backend.add_slot_listener(self.resize_remote_pool)
+            remote_backend.start()
+        self.allow_hardlinks = allow_hardlinks
+        self.index = TranscodeIndex(index_path)
+        self.run_log = run_log if run_log is not None else NullRunLog()
+
+        # Backend of the profiles that don't name one, the faster one on the first files of the run. Without any
+        # backend that can run them the pipe backend is used anyway, its errors tell what is missing.
+        automatic_profiles = [profile for profile in self.profiles if profile.backend is None]
+        candidates = backends.candidates_for(automatic_profiles) or [backends.backends['pipe']]
+        self.backend_selector = backends.BackendSelector(candidates, listener=self.notify_all, run_log=self.run_log)
+
+        self.lock = threading.Lock()
+        self.albums = set()  # submitted and not finished yet
+        self.album_of_job = {}
+        # Output path -> source, of all albums that aren't finished. All albums write into the same output folder, so
+        # two files must never get the same output (e.g. "01 - Intro.flac" of two albums, or "a.flac" and "a.mp3").
+        self.output_sources = {}
+        self.audio_seconds_done = 0.0
+
+        self.controller = None
+        if not workers and controller.is_supported():
+            self.controller = controller.ConcurrencyController(self.pool, lambda: self.audio_seconds_done,
+                                                               self.pool.pending_count, listener=self.notify_all,
+                                                               run_log=self.run_log)
+            self.controller.start()
+
+        # Entries are ((-priority,), submission order, album), None shuts the dispatcher down.
+        self.pending_albums = queue.PriorityQueue()
+        self.order = itertools.count()
+
+        self.dispatcher = threading.Thread(target=self.dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def resize_remote_pool(self, slots):
+        self.remote_pool.resize(slots)
+
+    @property
+    def workers(self):
+        return self.pool.workers
+
+    def submit(self, input_dir, priority=0, cancel_token=None, listener=None, items=None, file_done=None):
+        """ Queue an album folder (including its subfolders) for transcoding.
+
+        :param input_dir: str
+        :param priority: int, albums with a higher priority are started first
+        :param cancel_token: CancelToken or None, for a new one
+        :param listener: callable(album, message) or None
+        :param items: list of scanner.WorkItem or None, to scan input_dir
+        :param file_done: callable(album, path, action) or None
+        :return: AlbumJob
+        """
+        album = AlbumJob(input_dir, priority, cancel_token, listener, items, file_done)
+        with self.lock:
+            self.albums.add(album)
+        album.cancel_token.on_cancel(lambda: self.cancel_pending(album))
+        self.pending_albums.put(((-priority,), next(self.order), album))
+        return album
+
+    def active_albums(self):
+        with self.lock:
+            return list(self.albums)
+
+    def notify_all(self, message):
+        for album in self.active_albums():
+            album.notify(message)
+
+    def cancel_all(self):
+        for album in self.active_albums():
+            album.cancel()
+
+    def cancel_pending(self, album):
+        # Jobs flagged as cancelled are skipped by the workers and reported as finished right away. The ones already
+        # running are killed through the cancel token of the album.
+        with album.lock:
+            for job in album.jobs:
+                job.cancelled = True
+
+    def has_capacity(self):
+        """ True if the pools run out of work soon, i.e. it is a good moment to submit another album. """
+        pools = [self.pool] if self.remote_pool is None else [self.pool, self.remote_pool]
+        return self.pending_albums.empty() and all(pool.pending_count() < pool.workers for pool in pools)
+
+    def dispatch(self):
+        self.run_log.start_profile()
+        while True:
+            priority, order, album = self.pending_albums.get()
+            if album is None:  # shutdown() was called
+                self.run_log.stop_profile()
+                return
+            try:
+                self.dispatch_album(album)
+            except Cancelled:
+                pass
+            except Exception as e:
+                with album.lock:
+                    album.errors.append((album.input_dir, str(e)))
+                album.notify('Failed to read "%s": %s' % (album.input_dir, e))
+            with album.lock:
+                album.scanning = False
+            self.finish_if_done(album)
+
+    def dispatch_album(self, album):
+        album.cancel_token.raise_if_cancelled()
+
+        # Own temporary directory per album, next to the output so the final rename doesn't cross file systems, unless
+        # there is a separate staging folder.
+        os.makedirs(self.output_dir, exist_ok=True)
+        album.staging_dir = tempfile.mkdtemp(prefix='.transcode_', dir=self.staging_dir or self.output_dir)
+
+        # Copy files right away and hand the files to be transcoded to the workers while the folder (and all of its
+        # subfolders) is still being scanned.
+        # The cover art is written once the scan is done, when all cover files and pictures of the album are known.
+        items = album.items if album.items is not None else scanner.scan(album.input_dir)
+        album_covers = AlbumCovers()
+        for item in items:
+            album.cancel_token.raise_if_cancelled()
+            file_name = os.path.basename(item.path)
+            if item.action == scanner.ACTION_COVER:
+                album_covers.add_file(item.path)
+            elif item.action == scanner.ACTION_COPY:
+                destination_path = os.path.join(self.output_dir, output_name(item.path, album.input_dir) +
+                                                os.path.splitext(item.path)[1])
+                if not self.claim_outputs(album, item.path, [destination_path]):
+                    continue
+                with self.run_log.stage(item.path, 'index'):
+                    is_current = self.index.is_current(item.path, 'copy')
+                if is_current:
+                    album.notify('Skipping unchanged "%s" ...' % file_name)
+                else:
+                    self.submit_job(album, self.copy_pool, self.copy_file, item.path, destination_path)
+            elif item.action == scanner.ACTION_TRANSCODE:
+                output_paths = [profile.output_path(item.path, album.input_dir) for profile in self.profiles]
+                if not self.claim_outputs(album, item.path, output_paths):
+                    continue
+                with self.run_log.stage(item.path, 'index'):
+                    profiles = [profile for profile in self.profiles
+                                if not self.index.is_current(item.path, profile.settings)]
+                if not profiles:
+                    album.notify('Skipping unchanged "%s" ...' % file_name)
+                else:
+                    # The length of the audio is the estimated cost of the file, used to start the longest ones first.
+                    # Embedded pictures are looked for in the same read, until the folder has a cover.
+                    if album_covers.wants_picture(item.path):
+                        duration, picture = flacmeta.read_duration_and_picture(item.path)
+                        if picture is not None:
+                            album_covers.add_picture(item.path, picture)
+                    else:
+                        duration = flacmeta.read_duration(item.path)
+                    # Local and remote profiles are encoded by their own pools, each decodes the file once.
+                    local_profiles = [profile for profile in profiles if profile.backend != 'remote']
+                    remote_profiles = [profile for profile in profiles if profile.backend == 'remote']
+                    jobs = [(pool, (pool_profiles, duration)) for pool, pool_profiles in
+                            ((self.pool, local_profiles), (self.remote_pool, remote_profiles)) if pool_profiles]
+                    self.submit_jobs(album, self.transcode_file, item.path, jobs, cost=duration)
+            else:
+                album.notify('Skipping "%s" ...' % file_name)
+
+        cover_sources = album_covers.sources()
+        if cover_sources:
+            self.submit_job(album, self.copy_pool, self.write_covers, album.input_dir, cover_sources)
+
+    def claim_outputs(self, album, source_path, output_paths):
+        """ Remember output_paths as the outputs of source_path until the album is finished, False (and an error of
+        the album) if another file of any running album has one of them already.
+        """
+        with self.lock:
+            taken = [(output_path, self.output_sources[output_path]) for output_path in output_paths
+                     if self.output_sources.get(output_path, source_path) != source_path]
+            if not taken:
+                for output_path in output_paths:
+                    if output_path not in self.output_sources:
+                        self.output_sources[output_path] = source_path
+                        album.outputs.append(output_path)
+        if taken:
+            message = 'Same output "%s" as "%s"' % taken[0]
+            with album.lock:
+                album.errors.append((source_path, message))
+            album.notify('Failed to write "%s": %s' % (os.path.basename(source_path), message))
+            return False
+        return True
+
+    def submit_job(self, album, pool, function, path, *args, cost=0.0):
+        self.submit_jobs(album, function, path, [(pool, args)], cost=cost)
+
+    def submit_jobs(self, album, function, path, jobs, cost=0.0):
+        """ Hand one file to the pools as function(album, path, *args) for every (pool, args) of jobs. The file counts
+        once in the progress of the album, and is done once all of its jobs are.
+        """
+        with album.lock:
+            album.progress.add(cost)
+            album.pending_files[path] = len(jobs)
+            # Registered before the collector can possibly see the jobs finish.
+            with self.lock:
+                for pool, args in jobs:
+                    job = pool.submit(function, album, path, *args, cost=cost, priority=album.priority)
+                    self.album_of_job[job] = album
+                    album.jobs.append(job)
+                    if album.cancelled:
+                        job.cancelled = True
+
+    def collect(self):
+        while True:
+            job = self.pool.completed()
+            if job is None:  # shutdown() was called
+                return
+            with self.lock:
+                album = self.album_of_job.pop(job)
+
+            # A file is finished with its last job, and only done if none of its jobs failed.
+            path = job.args[1]
+            with album.lock:
+                album.pending_files[path] -= 1
+                file_finished = not album.pending_files[path]
+                if job.error is not None or job.cancelled:
+                    album.failed_files.add(path)
+                succeeded = file_finished and path not in album.failed_files
+                if file_finished:
+                    del album.pending_files[path]
+                    album.failed_files.discard(path)
+            if file_finished:
+                album.progress.finish(job.cost)
+
+            if job.error is None and not job.cancelled:
+                # Only what was encoded here, the controller adjusts the local pool by it.
+                if not (job.function == self.transcode_file and job.args[2][0].backend == 'remote'):
+                    self.audio_seconds_done += job.cost
+                # Covers aren't journaled, they are cheap to check and depend on the whole album.
+                if succeeded and album.file_done is not None and job.function != self.write_covers:
+                    action = 'transcode' if job.function == self.transcode_file else 'copy'
+                    album.file_done(album, path, action)
+            if not job.cancelled and not isinstance(job.error, Cancelled):
+                file_name = os.path.basename(job.args[1])
+                if job.error is not None:
+                    with album.lock:
+                        album.errors.append((job.args[1], str(job.error)))
+                if job.function == self.write_covers:
+                    if job.error is not None:
+                        album.notify('Failed to write the cover art of "%s": %s' % (album.name, job.error))
+                    for source, destination_path, method in job.result or []:
+                        source_name = os.path.basename(source.path)
+                        if source.picture is not None:
+                            source_name = 'the picture in "%s"' % source_name
+                        else:
+                            source_name = '"%s"' % source_name
+                        if method == 'duplicate':
+                            album.notify('Skipping %s, same image as "%s" ...' % (source_name,
+                                                                                  os.path.basename(destination_path)))
+                        else:
+                            album.notify('Copied %s as "%s" (%s), %s ...' % (source_name,
+                                                                             os.path.basename(destination_path), method,
+                                                                             album.progress))
+                elif job.function == self.transcode_file:
+                    if job.error is not None:
+                        album.notify('Failed to transcode "%s": %s' % (file_name, job.error))
+                    elif succeeded:
+                        album.notify('Transcoded "%s", %s ...' % (file_name, album.progress))
+                elif job.error is not None:
+                    album.notify('Failed to copy "%s": %s' % (file_name, job.error))
+                else:
+                    album.notify('Copied "%s" as "%s" (%s), %s ...' % (file_name, os.path.basename(job.args[2]),
+                                                                        job.result, album.progress))
+            self.finish_if_done(album)
+
+    def finish_if_done(self, album):
+        with album.lock:
+            if album.scanning or album.finished.is_set():
+                return
+            if album.progress.files_finished < album.progress.files_total:
+                return
+            album.finished.set()
+
+        if album.staging_dir is not None:
+            shutil.rmtree(album.staging_dir, ignore_errors=True)
+        with self.lock:
+            self.albums.discard(album)
+            for output_path in album.outputs:
+                del self.output_sources[output_path]
+        album.notify(None)
+
+    def copy_file(self, album, source_path, destination_path):
+        album.cancel_token.raise_if_cancelled()
+
+        # Passthrough files are staged in the temporary directory of the album, or next to their destination if the
+        # temporary directory is in a separate staging folder (which would only mean copying them twice).
+        staging_dir = album.staging_dir if self.staging_dir is None else None
+        with self.run_log.stage(source_path, 'copy', os.path.getsize(source_path)):
+            method = copier.copy_file(source_path, destination_path, self.allow_hardlinks, staging_dir)
+
+        self.index.record(source_path, 'copy', destination_path)
+        return method
+
+    def write_covers(self, album, input_dir, sources):
+        album.cancel_token.raise_if_cancelled()
+        with self.run_log.stage(input_dir, 'cover'):
+            return write_covers(sources, self.cover_art_output_dir, album.name, self.allow_hardlinks)
+
+    def transcode_file(self, album, input_file_path, profiles, duration):
+        # Using flac and the encoders directly, this leads to files with no tags at all though.
+        # Get all relevant tags of the source file beforehand, once for all profiles (album art is omitted on purpose).
+        with self.run_log.stage(input_file_path, 'tags'):
+            tags = get_tags(input_file_path, TAG_NAMES)
+
+        # The temporary directory of the album is in the output folder of the first profile, the files of the others
+        # are staged next to their destination. With a separate staging folder all of them are staged there.
+        outputs = []
+        for profile in profiles:
+            if not os.path.isdir(profile.output_dir):
+                os.makedirs(profile.output_dir, exist_ok=True)
+            if self.staging_dir is not None or profile.output_dir == self.output_dir:
+                staging_dir = album.staging_dir
+            else:
+                staging_dir = None
+            outputs.append((profile, profile.output_path(input_file_path, album.input_dir), staging_dir))
+
+        # An existing output is only overwritten if it was written for this file before, e.g. with other settings.
+        replaceable = {output_file_path for _, output_file_path, _ in outputs if os.path.lexists(output_file_path) and
+                       self.index.is_output_of(output_file_path, input_file_path)}
+
+        # Remember every file, so it is skipped the next time the same folder is dropped.
+        def committed(profile, output_file_path):
+            with self.run_log.stage(input_file_path, 'index'):
+                self.index.record(input_file_path, profile.settings, output_file_path)
+
+        # Outputs of the same backend are written together, decoding the file once. The tag values are passed on to
+        # the encoders, the files are written straight into the output folders.
+        automatic_backend = None
+        if any(profile.backend is None for profile in profiles):
+            automatic_backend = self.backend_selector.choose()
+        outputs_of_backend = {}
+        for output in outputs:
+            backend = backends.backends[output[0].backend] if output[0].backend else automatic_backend
+            outputs_of_backend.setdefault(backend, []).append(output)
+
+        error = None
+        for backend, backend_outputs in outputs_of_backend.items():
+            start = time.perf_counter()
+            try:
+                backend.transcode(input_file_path, backend_outputs, tags, cancel_token=album.cancel_token,
+                                  run_log=self.run_log, committed=committed, replaceable=replaceable)
+            except Cancelled:
+                raise
+            except Exception as e:
+                error = error or e
+                continue
+            if backend is automatic_backend:
+                self.backend_selector.record(backend, time.perf_counter() - start, duration)
+        if error is not None:
+            raise error
+
+    def shutdown(self):
+        """ Cancel whatever is still running and stop all threads. Returns the summary of the run log, if any. """
+        if self.controller is not None:
+            self.controller.stop()
+        self.cancel_all()
+        self.pending_albums.put(((float('inf'),), next(self.order), None))
+        self.dispatcher.join()
+        self.pool.shutdown()
+        self.copy_pool.shutdown()
+        if self.remote_pool is not None:
+            backends.backends['remote'].remove_slot_listener(self.resize_remote_pool)
+            self.remote_pool.shutdown()
+        self.pool.finished_jobs.put(None)
+        self.collector.join()
+        self.index.close()
+        return self.run_log.close()
@@ -1,11 +1,29 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import copy
 import json
 import os
+import shutil
+import sys
+import threading
 
+import backends
+import flacmeta
+import pipeline
+import profiles
+import remote
 
-def unify(default_settings, user_settings):
+
+def same_type(value, default):
+    """ True if value has the type of the setting with the default value default. """
+    if type(default) is float:
+        return type(value) in (int, float)
+    # bool is a subclass of int, but true is no number of workers.
+    return type(value) is type(default)
+
+
+def unify(default_settings, user_settings, problems=None, prefix=''):
     """ Compare the default settings with the user settings
 
     The following logic is being applied:
@@ -14,29 +32,44 @@ def unify(default_settings, user_settings):
     - If the user didn't specify a setting then use the default.
     - If the type of the user setting is different than the type of the default setting use the default.
 
+    Unknown settings and settings of the wrong type are noted in problems (if given), e.g. for a misspelled name.
+
     Limitations:
     - No range checks are performed on the user settings yet.
     - No "if value in ['a', 'b']" checks are performed on the user settings yet.
 
     :param default_settings: dict
     :param user_settings: dict
+    :param problems: list or None
+    :param prefix: str, path of the nested settings in problems, e.g. 'performance.'
     :return: dict
     """
+    if problems is None:
+        problems = []
     unified_settings = {}
 
     for key, value in default_settings.items():
         if key in user_settings:
-            if type(value) is dict:
-                new_val = unify(default_settings[key], user_settings[key])
+            if type(value) is dict and not isinstance(user_settings[key], dict):
+                problems.append('%s%s = %r is not a section, using the defaults' % (prefix, key, user_settings[key]))
+                new_val = default_settings[key]
+            elif type(value) is dict:
+                new_val = unify(default_settings[key], user_settings[key], problems, '%s%s.' % (prefix, key))
             else:
-                if isinstance(user_settings[key], type(value)):
+                if same_type(user_settings[key], value):
                     new_val = user_settings[key]
                 else:
+                    problems.append('%s%s = %r is no %s, using %r' % (prefix, key, user_settings[key],
+                                                                      type(value).__name__, value))
                     new_val = default_settings[key]
             unified_settings[key] = new_val
         else:
             unified_settings[key] = default_settings[key]
 
+    for key in user_settings:
+        if key not in default_settings:
+            problems.append('Unknown setting %s%s, ignored' % (prefix, key))
+
     return unified_settings
 
 
@@ -66,47 +99,246 @@ def compress(default_settings, current_settings):
 
 # Specify defaults in code of program, to make it impossible to overwrite them by the user or loose them somehow.
 default_s = {
-    'size': 1,
-    'position': {
-        'y': 2,
-        'x': 3,
-        'z': 4,
-        'gamma': {'hue': 21,
-                  'a': '45%'}
+    # Where the mp3s of the default profile, the copied mp3/m4a files and the cover art go.
+    'output_dir': os.path.join('~', 'Music', 'iTunes', 'iTunes Media', 'Automatically Add to iTunes.localized'),
+    'cover_art_output_dir': os.path.join('~', 'Downloads', 'iTunes Cover Art'),
+    # Remembers the files transcoded on previous runs, so they are skipped if they didn't change since.
+    'index_path': os.path.join('~', '.transcode', 'index.sqlite3'),
+    # Checkpoints of the current command line run, an interrupted run continues where it stopped.
+    'journal_path': os.path.join('~', '.transcode', 'journal.jsonl'),
+
+    # The default profile: mp3s encoded by lame with these options.
+    'lame_options': '-V0 --add-id3v2 --pad-id3v2 --ignore-tag-errors',
+    # 'pipe', 'ffmpeg' or '' to time both on the first files of a run and use the faster one. 'remote' encodes on the
+    # remote_workers.
+    'backend': '',
+    # Further encodings written at the same time, every FLAC file is decoded only once for all of them, e.g.
+    #     {"name": "aac", "encoder": "aac", "options": "-b:a 256k", "output_dir": "/Volumes/Media/aac"}
+    # with an optional "backend".
+    'profiles': [],
+    # Encode workers of remote.py on other machines, as "host:port".
+    'remote_workers': [],
+
+    # Full paths of the programs, '' looks them up on the PATH (and in the Homebrew/MacPorts folders).
+    'binaries': {
+        'flac': '',
+        'metaflac': '',
+        'lame': '',
+        'ffmpeg': '',
     },
-    'command': 'rm -r'
+
+    # Tuning for the machine at hand.
+    'performance': {
+        # Files transcoded at the same time, 0 adjusts the number to the load.
+        'workers': 0,
+        # Threads copying mp3/m4a files and cover art.
+        'copy_workers': 4,
+        # Hard link passthrough files instead of copying them, if on the same file system.
+        'allow_hardlinks': False,
+        # Added to the niceness of the flac/lame/ffmpeg processes (0-19), to keep the machine responsive.
+        'nice': 0,
+        # I/O priority of the same processes (Linux only): '' leaves it alone, 'best-effort' with a level of 0 (high) to
+        # 7 (low), or 'idle'.
+        'ionice_class': '',
+        'ionice_level': 4,
+        # Folder the files are encoded into before they are moved to the output folder, e.g. a tmpfs. '' encodes
+        # straight into a hidden folder inside the output folder.
+        'staging_dir': '',
+        # Size of the pipe between flac and the encoder in bytes, 0 keeps the size of the OS.
+        'pipe_buffer_size': 1024 * 1024,
+    },
+
+    # Per file, per stage timings as JSON lines, and cProfile statistics of the dispatching thread ('' turns them off).
+    'run_log_path': '',
+    'profile_path': '',
 }
 
+# The user's settings, only what differs from the defaults needs to be in there.
+settings_path = os.path.join(os.path.expanduser('~'), '.transcode', 'settings.json')
+
+
+def check(settings, problems, path, valid, message):
+    """ Replace the setting at path (list of keys) with its default unless valid(value), note why in problems. """
+    container = settings
+    default = default_s
+    for key in path[:-1]:
+        container = container[key]
+        default = default[key]
+    key = path[-1]
+    if not valid(container[key]):
+        problems.append('%s = %r %s, using %r' % ('.'.join(path), container[key], message, default[key]))
+        container[key] = default[key]
+
+
+def validate(settings):
+    """ Check the ranges and choices the types of unify() don't cover. Returns the settings and a list of problems. """
+    problems = []
+    check(settings, problems, ['backend'], lambda value: value in ('',) + tuple(backends.backends),
+          'is no backend')
+    check(settings, problems, ['performance', 'workers'], lambda value: value >= 0, 'is negative')
+    check(settings, problems, ['performance', 'copy_workers'], lambda value: value >= 1, 'is less than 1')
+    check(settings, problems, ['performance', 'nice'], lambda value: 0 <= value <= 19, 'is not between 0 and 19')
+    check(settings, problems, ['performance', 'ionice_class'], lambda value: value in ('', 'best-effort', 'idle'),
+          'is no I/O priority class')
+    check(settings, problems, ['performance', 'ionice_level'], lambda value: 0 <= value <= 7, 'is not between 0 and 7')
+    check(settings, problems, ['performance', 'staging_dir'],
+          lambda value: not value or os.path.isdir(os.path.expanduser(value)), 'is no folder')
+    check(settings, problems, ['performance', 'pipe_buffer_size'], lambda value: value >= 0, 'is negative')
+    for name in default_s['binaries']:
+        check(settings, problems, ['binaries', name],
+              lambda value: not value or os.access(os.path.expanduser(value), os.X_OK), 'is no program')
+
+    valid_profiles = []
+    for profile in settings['profiles']:
+        try:
+            if not isinstance(profile, dict) or not all(isinstance(profile.get(key), str) and profile.get(key)
+                                                        for key in ('name', 'encoder', 'output_dir')):
+                raise ValueError('needs a name, an encoder and an output_dir')
+            if profile.get('backend', '') not in ('',) + tuple(backends.backends):
+                raise ValueError('has no known backend')
+            profiles.OutputProfile(profile['name'], profile['encoder'], str(profile.get('options', '')),
+                                   profile['output_dir'])
+        except ValueError as e:
+            problems.append('Ignoring profile %r: %s' % (profile, e))
+            continue
+        valid_profiles.append(profile)
+    settings['profiles'] = valid_profiles
+
+    # Not replaced by anything, but the files of these profiles would fail.
+    encoders = [('default', 'lame', '')] + [(profile['name'], profile['encoder'], profile.get('backend', ''))
+                                            for profile in valid_profiles]
+    for name, encoder, backend in encoders:
+        program = 'lame' if encoder == 'lame' else 'ffmpeg'
+        binary = os.path.expanduser(settings['binaries'][program]) or pipeline.find_binary(program)
+        if backend != 'remote' and shutil.which(binary) is None:
+            problems.append('Profile "%s" needs %s, which is not installed' % (name, program))
+
+    valid_workers = []
+    for address in settings['remote_workers']:
+        try:
+            if not isinstance(address, str) or not address:
+                raise ValueError('is no "host:port"')
+            remote.parse_address(address)
+        except ValueError as e:
+            problems.append('Ignoring remote worker %r: %s' % (address, e))
+            continue
+        valid_workers.append(address)
+    settings['remote_workers'] = valid_workers
+
+    return settings, problems
+
+
+def path_setting(value):
+    return os.path.expanduser(value) if value else None
+
+
+class Settings(object):
+    """ The validated settings, with the types the code expects ('' and 0 for "not set" become None).
+
+    problems lists the settings of the file that were replaced by their defaults.
+    """
+
+    def __init__(self, values, problems=()):
+        self.values = values
+        self.problems = list(problems)
+        performance = values['performance']
+
+        self.output_dir = os.path.expanduser(values['output_dir'])
+        self.cover_art_output_dir = os.path.expanduser(values['cover_art_output_dir'])
+        self.index_path = os.path.expanduser(values['index_path'])
+        self.journal_path = os.path.expanduser(values['journal_path'])
+        self.lame_options = values['lame_options']
+        self.backend = values['backend'] or None
+        self.extra_profiles = [profiles.OutputProfile(profile['name'], profile['encoder'],
+                                                      str(profile.get('options', '')),
+                                                      os.path.expanduser(profile['output_dir']),
+                                                      profile.get('backend') or None)
+                               for profile in values['profiles']]
+        self.remote_workers = values['remote_workers']
+        self.binaries = {name: path_setting(path) for name, path in values['binaries'].items()}
+        self.workers = performance['workers'] or None
+        self.copy_workers = performance['copy_workers']
+        self.allow_hardlinks = performance['allow_hardlinks']
+        self.nice = performance['nice']
+        self.ionice_class = performance['ionice_class'] or None
+        self.ionice_level = performance['ionice_level']
+        self.staging_dir = path_setting(performance['staging_dir'])
+        self.pipe_buffer_size = performance['pipe_buffer_size']
+        self.run_log_path = path_setting(values['run_log_path'])
+        self.profile_path = path_setting(values['profile_path'])
+
+    def apply(self):
+        """ Hand the settings that apply to every process started from now on to the modules that start them. """
+        pipeline.pipe_buffer_size = self.pipe_buffer_size
+        pipeline.nice_level = self.nice
+        pipeline.ionice_class = self.ionice_class
+        pipeline.ionice_level = self.ionice_level
+        pipeline.flac_binary = self.binaries['flac'] or pipeline.find_binary('flac')
+        flacmeta.metaflac_binary = self.binaries['metaflac'] or pipeline.find_binary('metaflac')
+        profiles.lame_binary = self.binaries['lame'] or pipeline.find_binary('lame')
+        profiles.ffmpeg_binary = self.binaries['ffmpeg'] or pipeline.find_binary('ffmpeg')
+        backends.backends['remote'].configure(self.remote_workers)
+
+
+# Per settings file: (modification time, Settings).
+loaded_settings = {}
+loaded_settings_lock = threading.Lock()
+
+
+def load_settings(path=None):
+    """ Return the settings of the file at path (settings_path by default), merged with the defaults and validated.
+
+    The file is only read again when its modification time changed, otherwise the same Settings object is returned, so
+    comparing with the previous result tells whether anything changed. A missing or broken file means the defaults.
+
+    :param path: str or None
+    :return: Settings
+    """
+    if path is None:
+        path = settings_path
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    with loaded_settings_lock:
+        if path in loaded_settings and loaded_settings[path][0] == mtime:
+            return loaded_settings[path][1]
+
+        problems = []
+        user_s = {}
+        if mtime is not None:
+            try:
+                with open(path, 'r') as f:
+                    user_s = json.load(f)
+                if not isinstance(user_s, dict):
+                    raise ValueError('not a JSON object')
+            except (OSError, ValueError) as e:
+                problems.append('Can\'t read %s (%s), using the defaults' % (path, e))
+                user_s = {}
+
+        # unify() shares the nested defaults the user didn't change, validate() must not change those.
+        values, validation_problems = validate(copy.deepcopy(unify(default_s, user_s, problems)))
+        settings = Settings(values, problems + validation_problems)
+        loaded_settings[path] = (mtime, settings)
+        return settings
+
+
+def save_settings(settings, path=None):
+    """ Write only the non-defaults of settings (a Settings or dict of values) to the file at path. """
+    if path is None:
+        path = settings_path
+    values = settings.values if isinstance(settings, Settings) else settings
+    settings_dir = os.path.dirname(path)
+    if settings_dir and not os.path.isdir(settings_dir):
+        os.makedirs(settings_dir)
+    with open(path, 'w') as f:
+        json.dump(compress(default_s, values), f, indent=4)
+
 
 if __name__ == '__main__':
-    # Notes on usage & simple example here.
-
-    # Load the user's settings from a json file if this file exists. Otherwise just use the defaults.
-    user_s_path = 'settings_user.json'
-    if os.path.isfile(user_s_path):
-        with open(user_s_path, 'r') as f:
-            user_s = json.load(f)
-
-        # Unify the default settings with the user settings.
-        settings = unify(default_s, user_s)
-    else:
-        settings = default_s
-
-    # Access current settings.
-    print(settings['size'])
-    print(type(settings['size']))
-    print(settings['position']['x'])
-    print(settings['position']['y'])
-    print(settings['command'])
-
-    # Write the complete current settings to a new file.
-    complete_s_path = 'settings_current_complete.json'
-    with open(complete_s_path, 'w') as f:
-        json.dump(settings, f)
-
-    # Write only non-defaults to a new file.
-    non_default_s = compress(default_s, settings)
-    if len(non_default_s) > 0:
-        non_default_s_path = 'settings_current_compressed.json'
-        with open(non_default_s_path, 'w') as f:
-            json.dump(non_default_s, f)
+    # Show the settings in effect, and what was wrong with the file.
+    current = load_settings(sys.argv[1] if len(sys.argv) > 1 else None)
+    for problem in current.problems:
+        print(problem, file=sys.stderr)
+    print(json.dumps(current.values, indent=4))
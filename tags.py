@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import flacmeta
+
+# Tags copied from the FLAC file to the mp3 (album art is omitted on purpose).
+TAG_NAMES = ['ARTIST', 'TITLE', 'TRACKNUMBER', 'ALBUM', 'DATE', 'GENRE', 'DISCNUMBER']
+
+
+def get_tags(in_file_path, metaflac_strings):
+    # All tags are read at once from the metadata blocks at the start of the file, metaflac is only used as a fallback.
+    raw_tags = flacmeta.read_tags(in_file_path, metaflac_strings)
+    return {metaflac_string: transform_tag(raw_tags[metaflac_string], metaflac_string)
+            for metaflac_string in metaflac_strings}
+
+
+def better_capitalize(string):
+    # Just using .title() doesn't work reliably for single letter words (e.g. "I")
+    capitalized_string = ' '.join(word.capitalize() for word in string.split())
+
+    # The method above has a weakness capitalizing the first word inside brackets though.
+    if '(' in capitalized_string:
+        final_tag = []
+        for word in capitalized_string.split('('):
+            final_tag.append(word[0].upper() + word[1:])
+        capitalized_string = '('.join(final_tag)
+
+    return capitalized_string
+
+
+def transform_tag(tag_string, metaflac_string):
+    tag = tag_string.upper().replace('%s=' % metaflac_string.upper(), '')  # remove "tag=" so only value remains
+    tag = tag.replace('\n', '')  # no line breaks
+    tag = better_capitalize(tag)  # reliably capitalize each single word
+    return tag
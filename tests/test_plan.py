@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flacmeta
+from index import TranscodeIndex
+from plan import make_plan, PLAN_TRANSCODE
+from profiles import output_profiles
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='transcode_test_')
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.index = TranscodeIndex(os.path.join(self.temp_dir, 'index.sqlite3'))
+        self.addCleanup(self.index.close)
+
+    def test_unreadable_file(self):
+        album_dir = os.path.join(self.temp_dir, 'Album')
+        os.makedirs(album_dir)
+        for name in ('01.flac', '02.flac'):
+            with open(os.path.join(album_dir, name), 'wb') as f:
+                f.write(b'fLaC' + b'\0' * 1000)
+        unreadable_path = os.path.join(album_dir, '02.flac')
+        read_streaminfo = flacmeta.read_streaminfo
+
+        def read_unless_unreadable(in_file_path):
+            if in_file_path == unreadable_path:
+                raise PermissionError(13, 'Permission denied', in_file_path)
+            return read_streaminfo(in_file_path)
+
+        with mock.patch.object(flacmeta, 'read_streaminfo', read_unless_unreadable):
+            plan = make_plan([album_dir], self.index, output_profiles(self.temp_dir, '-V 2'))
+
+        # Both are planned, the run reports the one it can't read.
+        self.assertEqual(plan.totals[PLAN_TRANSCODE].files, 2)
+        self.assertEqual([item.path for item in plan.albums[0][1]],
+                         [os.path.join(album_dir, '01.flac'), unreadable_path])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import remote
+from profiles import OutputProfile
+from tags import TAG_NAMES
+
+# Stand-ins for the programs the workers run: flac "decodes" by printing the file, lame "encodes" by writing what it
+# reads to its output file, slowly enough that a worker can be killed while it has jobs.
+fake_flac = '#!/bin/sh\nfor last; do :; done\ncat "$last"\n'
+fake_lame = '#!/bin/sh\nfor last; do :; done\nsleep 0.2\ncat > "$last"\n'
+
+
+def write_script(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+@unittest.skipUnless(os.name == 'posix', 'the fake encoders are shell scripts')
+class RemoteWorkersTest(unittest.TestCase):
+    """ Two encode workers on localhost, one of them killed in the middle of the run. """
+
+    file_count = 24
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='transcode_test_')
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        bin_dir = os.path.join(self.temp_dir, 'bin')
+        os.makedirs(bin_dir)
+        write_script(os.path.join(bin_dir, 'flac'), fake_flac)
+        write_script(os.path.join(bin_dir, 'lame'), fake_lame)
+
+        environment = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+        remote_path = os.path.join(os.path.dirname(os.path.abspath(remote.__file__)), 'remote.py')
+        self.workers = []
+        self.addresses = []
+        for _ in range(2):
+            process = subprocess.Popen([sys.executable, remote_path, '--listen', '127.0.0.1:0', '--slots', '2'],
+                                       stdout=subprocess.PIPE, env=environment)
+            self.addCleanup(self.stop_worker, process)
+            self.workers.append(process)
+            # 'Listening on host:port with ...'
+            self.addresses.append(process.stdout.readline().decode('utf-8').split()[2])
+
+    @staticmethod
+    def stop_worker(process):
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+
+    def test_every_file_arrives_after_losing_a_worker(self):
+        backend = remote.RemoteBackend()
+        backend.configure(self.addresses)
+        slot_totals = []
+        backend.add_slot_listener(slot_totals.append)
+
+        input_dir = os.path.join(self.temp_dir, 'input')
+        output_dir = os.path.join(self.temp_dir, 'output')
+        os.makedirs(input_dir)
+        os.makedirs(output_dir)
+        profile = OutputProfile('mp3', 'lame', '-V 2', output_dir, 'remote')
+        tags = {name: '' for name in TAG_NAMES}
+
+        contents = {}
+        for i in range(self.file_count):
+            input_path = os.path.join(input_dir, '%02i.flac' % i)
+            contents[input_path] = ('file %i ' % i).encode('utf-8') * 1000
+            with open(input_path, 'wb') as f:
+                f.write(contents[input_path])
+
+        lock = threading.Lock()
+        finished = threading.Condition(lock)
+        errors = []
+        done = []
+
+        def transcode(input_path):
+            output_path = profile.output_path(input_path)
+            try:
+                backend.transcode(input_path, [(profile, output_path, None)], tags)
+            except Exception as e:
+                with lock:
+                    errors.append((input_path, e))
+            with lock:
+                done.append(input_path)
+                finished.notify()
+
+        threads = [threading.Thread(target=transcode, args=(input_path,)) for input_path in contents]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # Both workers are busy by the time the first files arrived, the jobs the killed one was running are retried.
+        with lock:
+            self.assertTrue(finished.wait_for(lambda: len(done) >= 4, timeout=30))
+        self.workers[0].kill()
+        for thread in threads:
+            thread.join(60)
+            self.assertFalse(thread.is_alive())
+
+        self.assertEqual(errors, [])
+        self.assertEqual(max(slot_totals), 4)
+        for input_path, content in contents.items():
+            with open(profile.output_path(input_path), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backends
+import flacmeta
+import pipeline
+import profiles
+from profiles import OutputProfile
+from scheduler import TranscodeScheduler
+
+# Stand-ins for flac and lame: flac "decodes" by printing the file, lame "encodes" by writing what it reads to its
+# output file, slowly enough that the albums of a test are transcoded at the same time.
+fake_flac = '#!/bin/sh\nfor last; do :; done\ncat "$last"\n'
+fake_lame = '#!/bin/sh\nfor last; do :; done\nsleep 0.5\ncat > "$last"\n'
+
+
+class FailingBackend(object):
+    """ A remote backend whose workers fail every file. """
+
+    name = 'remote'
+    automatic = False
+    addresses = ['127.0.0.1:7878']
+
+    def add_slot_listener(self, listener):
+        listener(2)
+
+    def remove_slot_listener(self, listener):
+        pass
+
+    def start(self):
+        pass
+
+    def transcode(self, input_file_path, outputs, tags, cancel_token=None, run_log=None, committed=None,
+                  replaceable=()):
+        raise RuntimeError('Worker failed')
+
+
+def write_script(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+def write_flac(path, audio):
+    """ A FLAC file with only a STREAMINFO block (30 s of 44.1 kHz stereo) in front of audio. """
+    packed = (44100 << 44) | (1 << 41) | (15 << 36) | (44100 * 30)
+    streaminfo = b'\x10\x00\x10\x00' + b'\0' * 6 + packed.to_bytes(8, 'big') + hashlib.md5(audio).digest()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + b'\x80' + len(streaminfo).to_bytes(3, 'big') + streaminfo + audio)
+
+
+@unittest.skipUnless(os.name == 'posix', 'the fake encoders are shell scripts')
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='transcode_test_')
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        bin_dir = os.path.join(self.temp_dir, 'bin')
+        os.makedirs(bin_dir)
+        write_script(os.path.join(bin_dir, 'flac'), fake_flac)
+        write_script(os.path.join(bin_dir, 'lame'), fake_lame)
+
+        for module, name, program in ((pipeline, 'flac_binary', 'flac'), (profiles, 'lame_binary', 'lame')):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, os.path.join(bin_dir, program))
+
+        self.output_dir = os.path.join(self.temp_dir, 'output')
+        self.scheduler = self.create_scheduler('-V 2')
+
+    def create_scheduler(self, lame_options, extra_profiles=None):
+        scheduler = TranscodeScheduler(self.output_dir, os.path.join(self.temp_dir, 'covers'), lame_options,
+                                       os.path.join(self.temp_dir, 'index.sqlite3'), workers=2, backend='pipe',
+                                       extra_profiles=extra_profiles)
+        self.addCleanup(scheduler.shutdown)
+        return scheduler
+
+    def transcode_album(self, scheduler, album_dir, file_done=None):
+        album = scheduler.submit(album_dir, file_done=file_done)
+        self.assertTrue(album.wait(30))
+        return album
+
+    def test_albums_with_the_same_track_name(self):
+        sources = {}
+        for album_name in ('First', 'Second'):
+            path = os.path.join(self.temp_dir, album_name, '01 - Intro.flac')
+            sources[path] = ('%s ' % album_name).encode('utf-8') * 1000
+            write_flac(path, sources[path])
+
+        albums = [self.scheduler.submit(os.path.dirname(path)) for path in sources]
+        for album in albums:
+            self.assertTrue(album.wait(30))
+
+        # One of them is written, the other one fails instead of overwriting it. The temporary directories of the albums
+        # are removed right after they finished.
+        outputs = [name for name in os.listdir(self.output_dir) if not name.startswith('.transcode_')]
+        self.assertEqual(outputs, ['01 - Intro.mp3'])
+        with open(os.path.join(self.output_dir, '01 - Intro.mp3'), 'rb') as f:
+            output = f.read()
+        failed = [album for album in albums if album.errors]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual([path for path, _ in failed[0].errors], [os.path.join(failed[0].input_dir, '01 - Intro.flac')])
+        written = [path for path in sources if not path.startswith(failed[0].input_dir + os.sep)]
+        self.assertEqual(output[-len(sources[written[0]]):], sources[written[0]])
+
+
+    def test_other_files_are_not_overwritten(self):
+        album_dir = os.path.join(self.temp_dir, 'Album')
+        write_flac(os.path.join(album_dir, '01 - Intro.flac'), b'audio' * 1000)
+        os.makedirs(self.output_dir)
+        output_path = os.path.join(self.output_dir, '01 - Intro.mp3')
+        with open(output_path, 'wb') as f:
+            f.write(b'another track')
+
+        album = self.transcode_album(self.scheduler, album_dir)
+        self.assertEqual(len(album.errors), 1)
+        with open(output_path, 'rb') as f:
+            self.assertEqual(f.read(), b'another track')
+
+    def test_previous_outputs_are_replaced(self):
+        album_dir = os.path.join(self.temp_dir, 'Album')
+        write_flac(os.path.join(album_dir, '01 - Intro.flac'), b'audio' * 1000)
+        self.assertEqual(self.transcode_album(self.scheduler, album_dir).errors, [])
+
+        # Other settings, the file is transcoded again and its output replaced.
+        self.assertEqual(self.transcode_album(self.create_scheduler('-V 0'), album_dir).errors, [])
+
+
+    def test_unreadable_file(self):
+        album_dir = os.path.join(self.temp_dir, 'Album')
+        for name in ('01.flac', '02.flac', '03.flac'):
+            write_flac(os.path.join(album_dir, name), name.encode('utf-8') * 1000)
+        unreadable_path = os.path.join(album_dir, '02.flac')
+
+        def unreadable(read):
+            def read_unless_unreadable(in_file_path, *args):
+                if in_file_path == unreadable_path:
+                    raise PermissionError(13, 'Permission denied', in_file_path)
+                return read(in_file_path, *args)
+            return read_unless_unreadable
+
+        with mock.patch.object(flacmeta, 'read_streaminfo', unreadable(flacmeta.read_streaminfo)), \
+                mock.patch.object(flacmeta, 'read_metadata', unreadable(flacmeta.read_metadata)):
+            album = self.transcode_album(self.scheduler, album_dir)
+
+        # Only the unreadable file fails, the others of the album are transcoded anyway.
+        self.assertEqual([path for path, _ in album.errors], [unreadable_path])
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, '01.mp3')))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, '03.mp3')))
+
+
+    def test_file_with_a_failed_remote_profile(self):
+        album_dir = os.path.join(self.temp_dir, 'Album')
+        for name in ('01.flac', '02.flac'):
+            write_flac(os.path.join(album_dir, name), name.encode('utf-8') * 1000)
+        extra_profiles = [OutputProfile('320', 'lame', '-b 320', os.path.join(self.temp_dir, '320'), 'remote')]
+        done = []
+        with mock.patch.dict(backends.backends, {'remote': FailingBackend()}):
+            scheduler = self.create_scheduler('-V 2', extra_profiles)
+            album = self.transcode_album(scheduler, album_dir, lambda album, path, action: done.append(path))
+
+        # The local mp3 files are written, but the files aren't done: the next run has to retry the remote profile.
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, '01.mp3')))
+        self.assertEqual(done, [])
+        self.assertEqual(sorted(path for path, _ in album.errors),
+                         [os.path.join(album_dir, '01.flac'), os.path.join(album_dir, '02.flac')])
+        self.assertEqual((album.progress.files_finished, album.progress.files_total), (2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
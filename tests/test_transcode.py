@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index import TranscodeIndex
+
+transcode_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'transcode.py')
+
+
+class DryRunTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='transcode_test_')
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.home_dir = os.path.join(self.temp_dir, 'home')
+        self.album_dir = os.path.join(self.temp_dir, 'Album')
+        os.makedirs(self.home_dir)
+        os.makedirs(self.album_dir)
+        with open(os.path.join(self.album_dir, '01.flac'), 'wb') as f:
+            f.write(b'fLaC' + b'\0' * 1000)
+
+    def dry_run(self):
+        subprocess.check_output([sys.executable, transcode_path, '--dry-run', self.album_dir],
+                                env=dict(os.environ, HOME=self.home_dir), stderr=subprocess.STDOUT)
+
+    def test_nothing_is_written(self):
+        self.dry_run()
+        self.assertEqual(os.listdir(self.home_dir), [])
+
+    def test_existing_index_is_left_alone(self):
+        settings_dir = os.path.join(self.home_dir, '.transcode')
+        index = TranscodeIndex(os.path.join(settings_dir, 'index.sqlite3'))
+        index.close()
+        files = sorted(os.listdir(settings_dir))
+
+        self.dry_run()
+        self.assertEqual(sorted(os.listdir(settings_dir)), files)
+
+    def test_read_only_index(self):
+        index_path = os.path.join(self.temp_dir, 'index.sqlite3')
+        source_path = os.path.join(self.album_dir, '01.flac')
+        index = TranscodeIndex(index_path)
+        index.record(source_path, 'copy', os.path.join(self.temp_dir, '01.flac'))
+        index.close()
+
+        index = TranscodeIndex(index_path, read_only=True)
+        self.addCleanup(index.close)
+        self.assertTrue(index.is_current(source_path, 'copy'))
+        with self.assertRaises(sqlite3.OperationalError):
+            index.record(source_path, 'other', os.path.join(self.temp_dir, '01.flac'))
+
+
+if __name__ == '__main__':
+    unittest.main()
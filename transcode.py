@@ -1,130 +1,188 @@
 #! /usr/bin/python
 # -*- coding: utf-8 -*-
 
+import argparse
 import os
-import shutil
-import subprocess
-import tempfile
-from datetime import datetime
+import sys
+
+from index import TranscodeIndex
+from journal import Journal, read_journal
+from plan import estimated_encode_speed, make_plan
+from profiles import output_profiles
+from runlog import format_summary, NullRunLog, RunLog
+from scheduler import TranscodeScheduler
+from settings import load_settings
 
 # Prerequisites & instructions -----------------------------------------------------------------------------------------
 
-# lame, flac and metaflac need to be installed on the system
+# lame and flac need to be installed on the system, metaflac is only used for files the built-in tag reader fails on
 
 # Change to the folder  that should be transcoded ...
 #     cd "/Volumes/Media/Music/Popular/Action Bronson/[2011] Well-Done"
 # and run this script by calling ...
 #     python3 /Users/guenther/Development/python3-transcode/transcode.py
+# or pass one or more album folders, or a whole library ...
+#     python3 /Users/guenther/Development/python3-transcode/transcode.py "/Volumes/Media/Music/Popular"
 
 # Settings -------------------------------------------------------------------------------------------------------------
 
-cover_art_output_dir = os.sep + os.path.join('Users', 'guenther', 'Downloads', 'iTunes Cover Art')
+# Read from ~/.transcode/settings.json, see settings.py for all of them and their defaults. The file only needs what
+# differs from the defaults, e.g.
+#     {"output_dir": "/Volumes/Media/mp3", "performance": {"workers": 4, "nice": 10, "staging_dir": "/dev/shm"}}
+# Run settings.py to see the settings in effect. The module level names below can still be overridden by scripts (the
+# benchmark points them at throwaway folders).
+
+config = load_settings()
+config.apply()
+for problem in config.problems:
+    print('Settings: %s' % problem, file=sys.stderr)
+
+cover_art_output_dir = config.cover_art_output_dir
+itunes_import_dir = config.output_dir
+lame_options = config.lame_options
+
+# Further encodings written at the same time as the mp3s above, each FLAC file is decoded only once for all of them.
+extra_profiles = config.extra_profiles
+
+# How the mp3s above are encoded: 'pipe' (flac piped into lame), 'ffmpeg' (one ffmpeg process decodes and encodes, needs
+# ffmpeg with libmp3lame) or None to time both on the first files of a run and use the faster one. Extra profiles name
+# their own backend.
+backend = config.backend
+
+# Remembers the files transcoded on previous runs, so they are skipped if they didn't change since.
+index_path = config.index_path
+
+# Write per file, per stage timings as JSON lines to this file (e.g. 'transcode_run.jsonl'), None to turn it off.
+run_log_path = config.run_log_path
+
+# Profile the Python side of a run with cProfile and write the statistics to this file, needs run_log_path.
+profile_path = config.profile_path
+
+# Checkpoints of the current run over the command line folders, an interrupted run continues where it stopped.
+journal_path = config.journal_path
+
+# Files transcoded at the same time (None adjusts the number to the load) unless -w says otherwise, and copied at the
+# same time.
+default_workers = config.workers
+copy_workers = config.copy_workers
+allow_hardlinks = config.allow_hardlinks
+
+# Encode into this folder (e.g. a tmpfs) instead of a hidden folder in the output folder.
+staging_dir = config.staging_dir
+
+
+def refresh_settings():
+    """ Pick up changes of the settings file for the processes started from now on.
+
+    That covers nice/ionice, the pipe buffer size and the programs, the rest needs a restart. Called by the long running
+    GUI and daemon before every album.
+    """
+    global config
+    current = load_settings()
+    if current is not config:
+        config = current
+        config.apply()
+        for problem in config.problems:
+            print('Settings: %s' % problem, file=sys.stderr)
+
+
+def create_scheduler(workers=None, run_log=None):
+    """ A TranscodeScheduler with the settings above, workers (None for default_workers) overrides the setting. """
+    if workers is None:
+        workers = default_workers
+    return TranscodeScheduler(itunes_import_dir, cover_art_output_dir, lame_options, index_path, workers, run_log,
+                              copy_workers, allow_hardlinks, extra_profiles, backend, staging_dir)
 
-itunes_import_dir = os.sep + os.path.join('Users', 'guenther', 'Music', 'iTunes', 'iTunes Media',
-                                          'Automatically Add to iTunes.localized')
 
 # Logic starts here ----------------------------------------------------------------------------------------------------
 
 
-class TranscodeDir(object):
-    def __init__(self, input_dir):
-        # Sanitize passed path
-        if input_dir.endswith('/'):
-            input_dir = input_dir[:-1]
-
-        # Check if cover output dir already exists, if not create.
-        if not os.path.isdir(cover_art_output_dir):
-            os.makedirs(cover_art_output_dir)
-
-        for parent, dir_name, file_paths in os.walk(input_dir):
-            files_to_transcode = []
-
-            # Copy files now and remember the files to be transcoded in the next step.
-            for file_path in file_paths:
-                if os.path.basename(file_path).startswith('.'):
-                    print('Skipping "%s" ...' % os.path.basename(file_path))
-                elif os.path.basename(file_path) == 'folder.jpg':
-                    print('Copying "%s" as "%s.jpg" ...' % (os.path.basename(file_path), os.path.basename(input_dir)))
-                    shutil.copy(os.path.join(parent, file_path), cover_art_output_dir)
-                    os.rename(os.path.join(cover_art_output_dir, 'folder.jpg'),
-                              os.path.join(cover_art_output_dir, os.path.basename(input_dir) + '.jpg'))
-                elif file_path.endswith('.mp3') or file_path.endswith('.m4a'):
-                    print('Copying "%s" ...' % os.path.basename(file_path))
-                    shutil.copy(os.path.join(parent, file_path), itunes_import_dir)
-                elif file_path.endswith('.flac'):
-                    files_to_transcode.append(file_path)
-                else:
-                    print('Skipping "%s" ...' % os.path.basename(file_path))
-
-            # Create a temporary directory.
-            temp_output = os.path.join(tempfile.gettempdir(), 'transcode_%s' % datetime.now().strftime('%Y%m%d%-H%M%S'))
-            os.mkdir(temp_output)
-
-            # Transcode files.
-            for n, file_path in enumerate(files_to_transcode):
-                input_file_path = os.path.join(parent, file_path)
-                output_file_path = os.path.join(temp_output, os.path.basename(file_path)[:-5] + '.mp3')
-
-                print('Transcoding file %i/%i ...' % (n + 1, len(files_to_transcode)))
-
-                # Using flac and lame directly, this leads to a file with no tags at all though.
-                # Get all relevant tags of the source file beforehand (album art is omitted on purpose).
-                tag_artist = self.get_tag(input_file_path, 'ARTIST')
-                tag_title = self.get_tag(input_file_path, 'TITLE')
-                tag_track_number = self.get_tag(input_file_path, 'TRACKNUMBER')
-                tag_album = self.get_tag(input_file_path, 'ALBUM')
-                tag_date = self.get_tag(input_file_path, 'DATE')
-                tag_genre = self.get_tag(input_file_path, 'GENRE')
-                tag_disk = self.get_tag(input_file_path, 'DISCNUMBER')
-
-                # print('%s - %s - %s - %s - %s - %s - %s' %
-                # (tag_artist, tag_date, tag_genre, tag_album, tag_disk, tag_track_number, tag_title))
-
-                # # Transcode by streaming flac output into the lame encoder, pass over the tag values to write.
-                command = '/usr/local/bin/flac -c -d "%s" |' % input_file_path
-                command += ' lame -V0 --add-id3v2 --pad-id3v2 --ignore-tag-errors --ta "%s" --tt "%s"' % \
-                           (tag_artist, tag_title)
-                command += ' --tn "%s" --tl "%s" --tg "%s" --ty "%s"' % \
-                           (tag_track_number, tag_album, tag_genre, tag_date)
-                command += ' --tv "TPOS=%s"' % tag_disk
-                command += ' - "%s"' % output_file_path
-                transcode_file = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                transcode_file.communicate()
-
-                # Move files from temporary directory to iTunes auto import folder.
-                shutil.move(output_file_path, itunes_import_dir)
-
-            # Remove temporary directory.
-            os.rmdir(temp_output)
-
-        print('Finished')
-
-    def get_tag(self, in_file_path, metaflac_string):
-        metaflac_command = '/usr/local/bin/metaflac "%s" --show-tag=%s' % (in_file_path, metaflac_string)
-        metaflac_tag = subprocess.Popen(metaflac_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        get_tag_out, get_tag_err = metaflac_tag.communicate()
-        return self.transform_tag(get_tag_out.decode('utf-8'), metaflac_string)  # bytes to UTF-8 string
-
-    @staticmethod
-    def better_capitalize(string):
-        # Just using .title() doesn't work reliably for single letter words (e.g. "I")
-        capitalized_string = ' '.join(word.capitalize() for word in string.split())
-
-        # The method above has a weakness capitalizing the first word inside brackets though.
-        if '(' in capitalized_string:
-            final_tag = []
-            for word in capitalized_string.split('('):
-                final_tag.append(word[0].upper() + word[1:])
-            capitalized_string = '('.join(final_tag)
-
-        return capitalized_string
-
-    def transform_tag(self, tag_string, metaflac_string):
-        tag = tag_string.upper().replace('%s=' % metaflac_string.upper(), '')  # remove "tag=" so only value remains
-        tag = tag.replace('\n', '')  # no line breaks
-        tag = self.better_capitalize(tag)  # reliably capitalize each single word
-        return tag
+def report(album, message):
+    if message is not None:
+        print(message)
+
+
+def run_batch(roots, workers=None, dry_run=False, resume=True, encode_speed=estimated_encode_speed):
+    """ Plan the work for all albums below roots, print the plan, and unless dry_run is set carry it out.
+
+    Every file that is done is written to the journal. If the run is interrupted (Ctrl+C, killed, power loss) the next
+    run over the same roots with the same settings skips the files in the journal, instead of checking them all again.
+    The same goes for a run in which files failed, the next run retries only those.
+
+    :return: int, exit status: 0 if everything was done, 1 if the run was cancelled or files failed
+    """
+    profiles = output_profiles(itunes_import_dir, lame_options, extra_profiles, backend)
+    encoder_settings = ' | '.join(profile.settings for profile in profiles)
+    done = read_journal(journal_path, roots, encoder_settings) if resume else None
+
+    index = TranscodeIndex(index_path, read_only=True)
+    try:
+        plan = make_plan(roots, index, profiles, done)
+    finally:
+        index.close()
+
+    if done is not None:
+        print('Resuming the interrupted run, %i files were done already' % len(done))
+    if workers is None:
+        workers = default_workers
+    print(plan.format(workers or os.cpu_count() or 1, encode_speed))
+    if dry_run:
+        return 0
+
+    journal = None
+    scheduler = None
+    run_log = RunLog(run_log_path, profile_path) if run_log_path else NullRunLog()
+    try:
+        journal = Journal(journal_path, roots, encoder_settings, done)
+        scheduler = create_scheduler(workers, run_log)
+        albums = [scheduler.submit(album_dir, listener=report, items=items,
+                                   file_done=lambda album, path, action: journal.record(path, action))
+                  for album_dir, items in plan.albums]
+        try:
+            for album in albums:
+                album.wait()
+        except KeyboardInterrupt:
+            scheduler.cancel_all()
+            for album in albums:
+                album.wait()
+
+        errors = [error for album in albums for error in album.errors]
+        if any(album.cancelled for album in albums):
+            print('Cancelled, run again to continue where it stopped')
+            return 1
+        elif errors:
+            print('Failed %i files:' % len(errors), file=sys.stderr)
+            for path, error in errors:
+                print('    %s: %s' % (path, error), file=sys.stderr)
+            print('Run again to retry them', file=sys.stderr)
+            return 1
+        journal.finish()
+        print('Finished %i albums' % len(albums))
+        return 0
+    finally:
+        # The collector of the scheduler may still record files in the journal until it is shut down.
+        if scheduler is not None:
+            summary = scheduler.shutdown()
+            if summary is not None:
+                print(format_summary(summary))
+        else:
+            run_log.close()
+        if journal is not None:
+            journal.close()
+
+
+def process_cl_args():
+    parser = argparse.ArgumentParser(description='Transcode FLAC albums to mp3.')
+    parser.add_argument('roots', nargs='*', help='album folders or whole libraries (default: the current folder)')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only print what would be done')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='files transcoded at the same time (default: adjusted while transcoding)')
+    parser.add_argument('--restart', action='store_true', help="don't resume an interrupted run, start over")
+    parser.add_argument('--speed', type=float, default=estimated_encode_speed,
+                        help='seconds of audio one worker encodes per second, for the time estimate')
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    TranscodeDir(os.getcwd())
+    args = process_cl_args()
+    sys.exit(run_batch(args.roots or [os.getcwd()], args.workers, args.dry_run, not args.restart, args.speed))
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+# Watches a drop folder for album folders arriving in it. Only the top level entries of the drop folder are of
+# interest, changes further down (e.g. a track being written to "Album/CD2/") are reported as a change of the top level
+# folder they belong to. Both watchers have the same interface:
+#     changes(timeout) -> set of top level names that were created, changed or removed
+
+# Flags from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, length of the name
+
+
+def list_entries(drop_dir):
+    """ Names of the folders in drop_dir, hidden ones (e.g. temporary folders of rsync) are left out. """
+    try:
+        with os.scandir(drop_dir) as entries:
+            return {entry.name for entry in entries
+                    if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False)}
+    except OSError:
+        return set()
+
+
+class InotifyWatcher(object):
+    """ Watches the drop folder and every folder below it with inotify (Linux only).
+
+    Events arrive as they happen, so an album folder counts as settled once there were no events for it for a while. A
+    watch is added for every folder in the tree, which stays cheap as only the folders still arriving generate events.
+    If the kernel event queue overflows the whole top level is reported as changed.
+    """
+
+    reports_file_changes = True
+
+    def __init__(self, drop_dir):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.drop_dir = drop_dir
+        self.watches = {}  # watch descriptor -> (top level name or None for the drop folder, path)
+        self.add_watch(drop_dir, None)
+        for name in list_entries(drop_dir):
+            self.add_tree(os.path.join(drop_dir, name), name)
+
+    def add_watch(self, path, name):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if path == self.drop_dir:
+                raise OSError(error, 'Can\'t watch "%s"' % path)
+            if error == errno.ENOSPC:
+                print('Out of inotify watches (fs.inotify.max_user_watches), not watching "%s"' % path)
+            return  # folders that vanished in the meantime are simply not watched
+        self.watches[wd] = (name, path)
+
+    def add_tree(self, path, name):
+        pending_dirs = [path]
+        while pending_dirs:
+            current_dir = pending_dirs.pop()
+            self.add_watch(current_dir, name)
+            try:
+                with os.scandir(current_dir) as entries:
+                    pending_dirs.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def changes(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            event_name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changed |= list_entries(self.drop_dir)
+                continue
+            if mask & IN_IGNORED:  # the folder was removed, the kernel dropped the watch
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+
+            name, path = self.watches[wd]
+            if name is None:  # an event in the drop folder itself
+                if not event_name or event_name.startswith('.'):
+                    continue
+                name = event_name
+            changed.add(name)
+
+            # Watch folders that were created or moved in, including everything that is already inside of them.
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(os.path.join(path, event_name), name)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """ Fallback for systems without inotify (or network shares that don't generate events).
+
+    Only the top level of the drop folder is listed every interval, so new and removed album folders are noticed. Files
+    arriving further down aren't, the daemon compares a signature of the folders that are still settling instead.
+    """
+
+    reports_file_changes = False
+
+    def __init__(self, drop_dir, interval=5.0):
+        self.drop_dir = drop_dir
+        self.interval = interval
+        self.entries = list_entries(drop_dir)
+        self.last_poll = time.monotonic()
+
+    def changes(self, timeout):
+        wait = self.last_poll + self.interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_poll = time.monotonic()
+
+        entries = list_entries(self.drop_dir)
+        changed = entries ^ self.entries
+        self.entries = entries
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(drop_dir, poll_interval=5.0, use_inotify=True):
+    """ InotifyWatcher where available, PollingWatcher otherwise. """
+    if use_inotify and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(drop_dir)
+        except (OSError, AttributeError) as e:
+            print('inotify is not available (%s), polling "%s" every %s s instead' % (e, drop_dir, poll_interval))
+    return PollingWatcher(drop_dir, poll_interval)